@@ -1,174 +1,425 @@
 #!/usr/bin/env python
-from gmap_get import get_map_stream, is_supported_map_type
+from gmap_get import is_supported_map_type, MapClient
+import gmap_get
+from fragment_cache import FragmentCache
 from log_transform import logpolar_transform
 from PIL import Image
-from image_distort import transform_image, compose, scale_tfm, translate_tfm
+from image_distort import transform_image, compose, scale_tfm, translate_tfm, vectorize_tfm, add_render_options, render_options, render_summary
 from mercator2ortho import mercator2ortho
+from canvas import ImageCanvas, StripCanvas, MemmapCanvas
 from math import *
-import shutil
+import instrument
+from functools import lru_cache
+import numpy as np
 from io import BytesIO
+import threading
+import queue
 import os
 
-cache_folder=None
+#FragmentCache, used to store downloaded fragments
+fragment_cache=None
 
-def make_alpha(fragment_size, alpha_gradient_size, margins=(0,0,0,0)):
+#Feather profiles: opacity (0...255) at the distance d from the edge, for the gradient size g. Used for d < g.
+alpha_profiles = {"linear": lambda d, g: 255/g*d,
+                  "cosine": lambda d, g: 127.5 - 127.5*np.cos(pi/g*d)}
+
+@lru_cache(maxsize=32)
+def _alpha_array(fragment_size, alpha_gradient_size, margins, profile):
+    fwidth, fheight = fragment_size
+    mtop, mbottom, mleft, mright = margins
+    alpha = np.zeros((fheight, fwidth), dtype=np.uint8)
+    width, height = fwidth-mleft-mright, fheight-mbottom-mtop
+    if width > 0 and height > 0:
+        #Opacity depends on the distance to the nearest side; quantize it through the table of the gradient values.
+        ramp = np.full(alpha_gradient_size+1, 255, dtype=np.uint8)
+        if alpha_gradient_size > 0:
+            ramp[:-1] = alpha_profiles[profile](np.arange(alpha_gradient_size), alpha_gradient_size).astype(int)
+        x = np.arange(width)
+        y = np.arange(height)
+        dx = np.minimum(np.minimum(x, width-x), alpha_gradient_size)
+        dy = np.minimum(np.minimum(y, height-y), alpha_gradient_size)
+        alpha[mtop:mtop+height, mleft:mleft+width] = ramp[np.minimum.outer(dy, dx)]
+    alpha.flags.writeable = False
+    return alpha
+
+def make_alpha(fragment_size, alpha_gradient_size, margins=(0,0,0,0), profile="linear"):
     """Create a monochrome image, white inside and fading to black at the sides gradually
     margins: [top bottom left right]
+    profile: shape of the gradient, one of alpha_profiles: "linear" or "cosine".
+    Masks are remembered, repeated calls with the same arguments don't compute them again.
     """
-    fwidth, fheight = fragment_size
-    if margins != (0,0,0,0):
-        mtop, mbottom, mleft, mright = margins
-        alpha = Image.new("L", fragment_size, 0)
-        alpha.paste( make_alpha( (fwidth-mleft-mright, fheight-mbottom-mtop), alpha_gradient_size, (0,0,0,0)),
-                     (mleft, mtop))
-        return alpha
-        
-    alpha = Image.new("L", fragment_size,255)
-    alpha_pix = alpha.load()
-    s = 255/alpha_gradient_size
-    for y in range(alpha_gradient_size):
-        for x in range(0, fwidth):
-            k = int(s*min(x,y))
-            alpha_pix[x,y] = k
-        for x in range(alpha_gradient_size, fwidth-alpha_gradient_size):
-            alpha_pix[x,y] = k
-        for x in range(fwidth-alpha_gradient_size, fwidth):
-            k = int(s*min(fwidth-x,y))
-            alpha_pix[x,y] = k
-    for y in range(alpha_gradient_size, fheight-alpha_gradient_size):
-        for x in range(0, alpha_gradient_size):
-            k = int(s*x)
-            alpha_pix[x,y] = k
-        for x in range(fwidth-alpha_gradient_size, fwidth):
-            k = int(s*(fwidth-x))
-            alpha_pix[x,y] = k
-    for y in range(fheight-alpha_gradient_size,fheight):
-        for x in range(0, alpha_gradient_size):
-            k = int(s*min(x,fheight-y))
-            alpha_pix[x,y] = k
-        for x in range(alpha_gradient_size, fwidth-alpha_gradient_size):
-            alpha_pix[x,y] = k
-        for x in range(fwidth-alpha_gradient_size, fwidth):
-            k = int(s*min(fwidth-x,fheight-y))
-            alpha_pix[x,y] = k
-    return alpha
+    if profile not in alpha_profiles:
+        raise ValueError("Unknown alpha profile: {0}".format(profile))
+    return Image.fromarray(_alpha_array(tuple(fragment_size), alpha_gradient_size, tuple(margins), profile), "L")
 
-def get_map_cached(coordinates, zoom, fragment_size, map_type, scale):
-    global cache_folder
-    if cache_folder is None:
-        return get_map_at(coordinates, zoom, fragment_size, map_type, scale)
-    
-    lat, lon = coordinates
-    width, height = fragment_size
-    map_name = "map-{lat:0.10f}-{lon:0.10f}-{zoom}-{width}-{height}-{map_type}-{scale}.png".format(**locals())
-        
-    map_path = os.path.join(cache_folder, map_name)
-    if os.path.exists(map_path):
-        print("Using cached data")
-        with open(map_path, "rb") as map_file:
-            return Image.open(map_file).convert("RGBA")
-    else:
-        print("Cache miss")
-        stream = get_map_stream(coordinates, zoom, fragment_size, map_type, "PNG", scale=scale)
-        data = stream.read()
-        stream.close()
-        with open(map_path, "wb") as map_file:
-            map_file.write(data)
-        return Image.open(BytesIO(data)).convert("RGBA")
-    
-def get_map_at(coordinates, zoom, fragment_size, map_type, scale):
-    stream = get_map_stream(coordinates, zoom, fragment_size, map_type, "PNG", scale=scale)
-    fragment = Image.open(BytesIO(stream.read())).convert("RGBA")
-    stream.close()
-    return fragment
+def _no_progress(*args, **kwargs):
+    pass
+
+def iter_fragments(coordinates, zooms, fragment_size, map_type, scale, client, verbose=True):
+    """Get the map fragments for several zoom levels, from the cache or by downloading.
+    Downloads of all fragments, missing in the cache, are started at once, as one batch. 
+    Generates fragments in the order of zooms, as soon as they are available. 
+    Fragment is either bytes of the PNG file, or decoded RGBA image (when taken from the raw cache).
+    verbose: print progress messages.
+    """
+    progress = print if verbose else _no_progress
+    pending = []
+    for zoom in zooms:
+        key = FragmentCache.key(coordinates, zoom, fragment_size, map_type, scale, client.base_url)
+        if fragment_cache is not None:
+            if fragment_cache.raw:
+                fragment = fragment_cache.get_image(key)
+            else:
+                fragment = fragment_cache.get_data(key)
+            if fragment is not None:
+                pending.append((key, fragment, None))
+                continue
+        pending.append((key, None, client.submit(center=coordinates, zoom=zoom, size=fragment_size, 
+                                                 type=map_type, format="png", scale=scale)))
+    progress ("Fragments in cache: {0}, downloading: {1}".format(
+        sum(1 for _, _, future in pending if future is None), 
+        sum(1 for _, _, future in pending if future is not None)))
+    for key, fragment, future in pending:
+        if future is not None:
+            fragment = future.result()
+            if fragment_cache is not None:
+                fragment = fragment_cache.put(key, fragment) or fragment
+        yield fragment
+
+def fetch_fragments(coordinates, zooms, fragment_size, map_type, scale, client):
+    """Same as iter_fragments, but returns list of all fragments"""
+    return list(iter_fragments(coordinates, zooms, fragment_size, map_type, scale, client))
+
+def fragment_transform(coordinates, zoom, fragment_size, out_width, scale, mercator_to_ortho=True):
+    """Transform from the log-polar view to the image of the map fragment, and vertical position of the fragment in the glued image.
+    Position is measured from an arbitrary origin, only differences between zoom levels matter.
+    Returns (tfm, y)
+    """
+    if not mercator_to_ortho:
+        #Increasing zoom by one level offsets image by this amount in the logarithmic view
+        zoom_level_offset = (0.5*log(2)/pi)*out_width
+        _, tfm = logpolar_transform(
+            fragment_size, 
+            scale_tfm(0.5)(*fragment_size),
+            out_width=out_width)
+        return tfm, zoom * zoom_level_offset
+
+    longitude_extent = (2*pi)*fragment_size[0]/256/scale*(0.5)**zoom
+    #Make a transform from mercator to orthogonal
+    out_ortho_size, merc2otrho_tfm, ortho_pix_size = mercator2ortho(
+        fragment_size,
+        coordinates[0]/180*pi,  #latitude
+        longitude_extent, 
+        out_width
+    )
+    _, log_tfm = logpolar_transform(
+        out_ortho_size, 
+        center = scale_tfm(0.5)(*out_ortho_size),
+        out_width=out_width
+    )
+    return compose( merc2otrho_tfm, log_tfm ), -(0.5/pi*log(ortho_pix_size))*out_width
+
+def fragment_row_coverage(tfm, size, alpha, samples=256):
+    """Rows of the transformed fragment, where it is not empty, and where it is fully opaque.
+    tfm: transform from the transformed image of the given size to the fragment; alpha: HxW array of the fragment alpha.
+    Every row is tested in the samples points, without rendering.
+    Returns 2 boolean arrays, one value per row.
+    """
+    width, height = size
+    x, y = np.meshgrid((np.arange(samples)+0.5)*width/samples, np.arange(height)+0.5)
+    u, v = vectorize_tfm(tfm)(x.ravel(), y.ravel())
+    instrument.count("transform_points", u.size)
+    fheight, fwidth = alpha.shape
+    with np.errstate(invalid="ignore"):
+        inside = (u >= 0) & (u < fwidth) & (v >= 0) & (v < fheight)
+    opacity = np.zeros(u.shape, dtype=np.uint8)
+    opacity[inside] = alpha[v[inside].astype(np.intp), u[inside].astype(np.intp)]
+    opacity = opacity.reshape(height, samples)
+    return (opacity > 0).any(axis=1), (opacity == 255).all(axis=1)
+
+def fragment_bands(offsets, coverages, height, out_height, margin=0, align=1):
+    """Bands of rows of the transformed fragments, that are visible in the glued image.
+    offsets: rows of the glued image, where fragments are placed, in the order of glueing.
+    coverages: (nonempty, opaque) row arrays of the fragments (see fragment_row_coverage), every one has height rows.
+    Band of the fragment starts at its first non-empty row and ends where the rest of the glued image is fully covered
+    by the opaque rows of the next fragments. Bands are extended by margin rows, and aligned to the multiples of align.
+    Returns list of (y0, y1) pairs in the fragment rows; y0 >= y1 for the fragments, that are not visible.
+    """
+    bands = [None] * len(offsets)
+    #Rows from covered to the bottom of the glued image are covered by the fragments, glued later
+    covered = out_height
+    for i in range(len(offsets)-1, -1, -1):
+        nonempty, opaque = coverages[i]
+        dy = offsets[i]
+        if nonempty.any():
+            y0 = max(0, int(np.argmax(nonempty)) - margin) // align * align
+            y1 = min(height, covered - dy + margin, out_height - dy)
+            y1 = min(height, -(-y1 // align) * align)
+        else:
+            y0 = y1 = 0
+        bands[i] = (y0, y1)
+        #Opaque rows at the bottom of the fragment
+        opaque_from = height - int(np.argmin(opaque[::-1])) if not opaque.all() else 0
+        if opaque_from < height and dy + height >= covered:
+            covered = min(covered, dy + opaque_from)
+    return bands
+
+def run_pipeline(items, stages, queue_size=2):
+    """Process items by the sequence of functions, every function (and iteration over the items) in its own thread.
+    Stages are connected by queues, holding at most queue_size items. 
+    Generates results of the last stage in the order of items. Exception, raised in any stage, is re-raised in the caller.
+    """
+    done = object()
+    stop = threading.Event()
+    queues = [queue.Queue(queue_size) for _ in range(len(stages)+1)]
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return False, done
+
+    def feed():
+        try:
+            for item in items:
+                if not put(queues[0], (True, item)): return
+            put(queues[0], (True, done))
+        except BaseException as err:
+            put(queues[0], (False, err))
+
+    def work(func, qin, qout):
+        while True:
+            ok, item = get(qin)
+            if ok and item is not done:
+                try:
+                    item = func(item)
+                except BaseException as err:
+                    ok, item = False, err
+            if not put(qout, (ok, item)) or not ok or item is done:
+                return
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    threads.extend(threading.Thread(target=work, args=(func, qin, qout), daemon=True)
+                   for func, qin, qout in zip(stages, queues[:-1], queues[1:]))
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            ok, item = get(queues[-1])
+            if not ok: raise item
+            if item is done: break
+            yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
     
+def glued_image_size(zoom_range, out_width):
+    """Size of the image, glued by download_and_glue"""
+    z0, z1 = zoom_range
+    zoom_level_offset = (0.5*log(2)/pi)*out_width
+    return out_width, int(zoom_level_offset * (z1-z0+1))
+
 def download_and_glue(coordinates,
                       zoom_range=(0,19), 
                       fragment_size=(512,512), 
                       out_width = 1024, 
                       alpha_gradient_size=10, 
+                      alpha_profile="linear",
                       map_type="roadmap", 
                       mercator_to_ortho=True, 
                       mesh_step=8,
                       scale=2,
-                      margins=(0,0,0,0)):
-
-
+                      margins=(0,0,0,0),
+                      mesh_tolerance=None,
+                      engine="mesh",
+                      resample=Image.BICUBIC,
+                      jobs=1,
+                      plan_cache=None,
+                      mipmap=False,
+                      canvas=None,
+                      band_limited=True,
+                      strip_store=None,
+                      client=None,
+                      pipeline=True,
+                      queue_size=2,
+                      verbose=True):
+    """Download map fragments of the point for the range of zoom levels, transform them to log-polar coordinates and glue them.
+    mipmap: sample the fragments from their mipmap pyramids, avoiding aliasing in the far regions of the fragments.
+    plan_cache: PlanCache for the meshes of the fragment transforms. They depend only on the latitude and the render settings.
+    canvas: where the fragments are glued (see canvas.py), its size must be glued_image_size(zoom_range, out_width).
+      Default is the image in memory. Returns the result of canvas.close(): the glued image for the default canvas.
+    band_limited: transform only the rows of the fragments, that are visible in the glued image (see fragment_bands).
+      Fragments, that are not visible at all, are not downloaded.
+    strip_store: StripStore, where transformed fragments are kept with the fingerprints of their inputs.
+      Zoom levels with stored strips are neither downloaded nor transformed again.
+      Bands, cut by the bottom of the glued image, are rendered and stored down to the bottom of the transformed fragment,
+      so that they stay usable when the zoom range is extended.
+    client: MapClient, used to download fragments. By default, new client with default settings is used.
+    pipeline: if True, downloading, decoding, transforming and glueing of the different zoom levels are done concurrently,
+      in separate threads, connected by queues of queue_size items. Result is the same as without pipeline.
+      With jobs>1, fragments are transformed in the calling thread, which forks the worker processes.
+    verbose: print progress messages.
+    """
+    progress = print if verbose else _no_progress
     #Increasing zoom by one level offsets image by this amount in the logarithmic view
     zoom_level_offset = (0.5*log(2)/pi)*out_width
 
     fragment_size_scaled = tuple(s*scale for s in fragment_size)
 
     #Prepare alpha
-    alpha = make_alpha(fragment_size_scaled, alpha_gradient_size, margins)
+    alpha = make_alpha(fragment_size_scaled, alpha_gradient_size, margins, alpha_profile)
 
     z0, z1 = zoom_range
-    out_height = int(zoom_level_offset * (z1-z0+1))
-    print ("Output image size: {out_width}x{out_height}".format(**locals()))
-    out_image = Image.new("RGBA",(out_width, out_height))
-    dy_base = None
-    for zoom in range(z0,z1+1):
-        print ("Downloading fragment, zoom={zoom}... ".format(**locals()), end='', flush=True)
-        fragment = get_map_cached(coordinates, zoom, fragment_size, map_type, scale)
-        fragment.putalpha(alpha)
-        print ("done, downloaded size: {fragment.size}".format(**locals()))
-
-        if not mercator_to_ortho:
-            dy = (zoom-z0) * zoom_level_offset
-            _, tfm = logpolar_transform(
-                fragment.size, 
-                scale_tfm(0.5)(*fragment.size),
-                out_width=out_width)
+    out_size = glued_image_size(zoom_range, out_width)
+    progress ("Output image size: {0}x{1}".format(*out_size))
+    if canvas is None:
+        canvas = ImageCanvas(out_size)
+    elif tuple(canvas.size) != out_size:
+        raise ValueError("Canvas size {0} does not match the glued image size {1}".format(canvas.size, out_size))
 
-        else:
-            longitude_extent = (2*pi)*fragment.size[0]/256/scale*(0.5)**zoom
-            #Make a transform from mercator to orthogonal
-            out_ortho_size, merc2otrho_tfm, ortho_pix_size = mercator2ortho(
-                fragment.size,
-                coordinates[0]/180*pi,  #latitude
-                longitude_extent, 
-                out_width
-            )
-            _, log_tfm = logpolar_transform(
-                out_ortho_size, 
-                center = scale_tfm(0.5)(*out_ortho_size),
-                out_width=out_width
-            )
-
-            if dy_base is None:
-                dy_base = (0.5/pi*log(ortho_pix_size))*out_width
-                dy = 0
-            else:
-                dy = dy_base - (0.5/pi*log(ortho_pix_size))*out_width
-            tfm = compose( merc2otrho_tfm, log_tfm )
+    zooms = list(range(z0,z1+1))
+    transformed_size = (out_width, int(zoom_level_offset*3))
+    transforms = [fragment_transform(coordinates, zoom, fragment_size_scaled, out_width, scale, mercator_to_ortho)
+                  for zoom in zooms]
+    y_base = transforms[0][1]
+    offsets = [int(y - y_base) for _, y in transforms]
+    #Fragments of the higher zooms are glued lower, so rows above the next fragment are finished
+    rows_finished = offsets[1:] + [out_size[1]]
+    for i in range(len(rows_finished)-2, -1, -1):
+        rows_finished[i] = min(rows_finished[i], rows_finished[i+1])
+    if band_limited:
+        #Margin covers interpolation of the mesh and the resampling filter; bands are aligned to the mesh
+        alpha_array = np.asarray(alpha)
+        coverages = [fragment_row_coverage(tfm, transformed_size, alpha_array) for tfm, _ in transforms]
+        bands = fragment_bands(offsets, coverages, transformed_size[1], out_size[1], margin=mesh_step+4, align=mesh_step)
+    else:
+        bands = [(0, transformed_size[1])] * len(zooms)
 
+    if strip_store is not None:
+        #Fragments of different map servers differ, so the server is a part of the fingerprint
+        map_url = (client is not None and client.base_url) or gmap_get.map_api_url
+        strip_keys = [strip_store.key(map_url=map_url, coordinates=coordinates, zoom=zoom, fragment_size=fragment_size, map_type=map_type, scale=scale,
+                                      out_width=out_width, mercator_to_ortho=mercator_to_ortho,
+                                      alpha_gradient_size=alpha_gradient_size, alpha_profile=alpha_profile, margins=margins,
+                                      mesh_step=mesh_step, mesh_tolerance=mesh_tolerance, engine=engine, resample=resample, mipmap=mipmap)
+                      for zoom in zooms]
+        stored = [band[1] > band[0] and strip_store.contains(key, band) for key, band in zip(strip_keys, bands)]
+        #Bands, that reach the bottom of the glued image, would be cut shorter than the ones of the extended zoom range
+        rendered_bands = [(y0, transformed_size[1]) if y1 > y0 and dy + y1 >= out_size[1] else (y0, y1)
+                          for (y0, y1), dy in zip(bands, offsets)]
+    else:
+        stored = [False] * len(zooms)
+        rendered_bands = bands
+    #Zoom levels, that have to be downloaded and transformed
+    fetched_zooms = [zoom for zoom, band, is_stored in zip(zooms, bands, stored) if band[1] > band[0] and not is_stored]
+    if len(fetched_zooms) < len(zooms):
+        progress ("Zoom levels to download: {0} of {1}".format(len(fetched_zooms), len(zooms)))
 
-        transformed_size = (out_width, int(zoom_level_offset*3))
-        
-        #Put transformed image to the output
-        print("    Transforming fragment...", end='', flush=True)
-        transformed=transform_image(fragment, tfm, transformed_size, mesh_step=mesh_step)
-        print("Done, created {transformed.size} image.".format(**locals()))
-        paste_with_alpha(out_image, 
-                         transformed,
-                         (0, int(dy)))
-        print ("Done")
-    return out_image
-
-def paste_with_alpha(bg, img, offset):
-    """Same as image.paste, but correctly works when source has gamma too"""
-    r, g, b, a = img.split()
-    transformed_rgb = Image.merge("RGB", (r, g, b))
-    transformed_mask = Image.merge("L", (a,))
-    bg.paste(transformed_rgb, offset, transformed_mask)
-    return bg
+    def decode(item):
+        zoom, fragment = item
+        if fragment is None: return item
+        with instrument.stage("decode"):
+            if isinstance(fragment, bytes):
+                fragment = Image.open(BytesIO(fragment)).convert("RGBA")
+            fragment.putalpha(alpha)
+        return zoom, fragment
 
-if __name__=="__main__":
+    def transform(item):
+        zoom, fragment = item
+        tfm, _ = transforms[zoom-z0]
+        band_y0, band_y1 = bands[zoom-z0]
+        if band_y1 <= band_y0:
+            progress("Fragment zoom={0} is not visible, skipped".format(zoom))
+            return zoom, None, offsets[zoom-z0]
+        if fragment is None:
+            transformed = strip_store.get(strip_keys[zoom-z0], (band_y0, band_y1))
+            if transformed is not None:
+                progress("Loaded stored fragment zoom={0}, rows {1}:{2}".format(zoom, band_y0, band_y1))
+                return zoom, transformed, offsets[zoom-z0] + band_y0
+            #Store is only a cache: get the fragment and render it again
+            progress("Stored fragment zoom={0} can not be read, rendering it again".format(zoom))
+            _, fragment = decode((zoom, next(iter_fragments(coordinates, [zoom], fragment_size, map_type, scale, client, verbose))))
+        band_y1 = rendered_bands[zoom-z0][1]
+        if band_y0 > 0:
+            tfm = compose(tfm, translate_tfm(0, band_y0))
+        render_stats = {}
+        transformed=transform_image(fragment, tfm, (out_width, band_y1-band_y0), mesh_step=mesh_step, mesh_tolerance=mesh_tolerance, stats=render_stats,
+                                    engine=engine, resample=resample, jobs=jobs, plan_cache=plan_cache,
+                                    mipmap=mipmap)
+        instrument.count("band_rows_skipped", transformed_size[1] - (band_y1-band_y0))
+        progress("Transformed fragment zoom={0}, size {1}, rows {2}:{3}. {4}".format(zoom, fragment.size, band_y0, band_y1, render_summary(render_stats)))
+        if strip_store is not None:
+            strip_store.put(strip_keys[zoom-z0], (band_y0, band_y1), transformed)
+        return zoom, transformed, offsets[zoom-z0] + band_y0
 
-    from optparse import OptionParser
-    parser = OptionParser(usage = "%prog [options] LATITUDE LONGITUDE [OUTPUT]\n"
-                          "Create automatically glued, logarithmic map of a point")
+    own_client = client is None
+    if own_client:
+        client = MapClient()
+    try:
+        def iter_items():
+            #Fragments of the zoom levels, or None for the ones, that don't need downloading
+            downloaded = iter_fragments(coordinates, fetched_zooms, fragment_size, map_type, scale, client, verbose)
+            for zoom in zooms:
+                yield zoom, (next(downloaded) if zoom in fetched_zooms else None)
+        fragments = iter_items()
+        if pipeline and jobs > 1:
+            #Transform forks the pool of processes; fork only from this thread, not from the pipeline ones
+            transformed_fragments = map(transform, run_pipeline(fragments, [decode], queue_size=queue_size))
+        elif pipeline:
+            transformed_fragments = run_pipeline(fragments, [decode, transform], queue_size=queue_size)
+        else:
+            transformed_fragments = (transform(decode(item)) for item in fragments)
+
+        for zoom, transformed, dy in transformed_fragments:
+            #Put transformed image to the output
+            if transformed is not None:
+                with instrument.stage("composite"):
+                    canvas.composite(transformed, (0, dy))
+            canvas.finish_rows(rows_finished[zoom-z0])
+            progress ("Glued fragment zoom={zoom}".format(**locals()))
+    finally:
+        if own_client:
+            client.close()
+    return canvas.close()
 
+def glue_to_file(coordinates, zoom_range, output, tile_size=256, tile_format="png", canvas_file=None, **kwargs):
+    """Glue the map by download_and_glue, and write it to the output file.
+    Output with .dzi extension is written as DeepZoom tile pyramid (see tile_pyramid.py), by strips, as they are finished.
+    canvas_file: glue in the memory-mapped file (see canvas.MemmapCanvas) and encode it by strips; output must be PNG.
+      The file is removed, when the output is written.
+    Other arguments are passed to download_and_glue.
+    """
+    out_size = glued_image_size(zoom_range, kwargs.get("out_width", 1024))
+    if output.lower().endswith(".dzi"):
+        from tile_pyramid import TilePyramidWriter
+        with TilePyramidWriter(output, out_size, tile_size, tile_format) as tiles:
+            download_and_glue(coordinates, zoom_range=zoom_range, canvas=StripCanvas(out_size, tiles), **kwargs)
+        if kwargs.get("verbose", True):
+            print ("Written {0} tiles".format(tiles.tiles_written))
+        return
+    if canvas_file and not output.lower().endswith(".png"):
+        raise ValueError("Canvas file requires PNG output file")
+    canvas = MemmapCanvas(canvas_file, out_size) if canvas_file else None
+    img = download_and_glue(coordinates, zoom_range=zoom_range, canvas=canvas, **kwargs)
+    with instrument.stage("encode"):
+        img.save(output)
+    if canvas_file:
+        os.unlink(canvas_file)
+
+def add_glue_options(parser):
+    """Add options of the downloading and glueing to the OptionParser. Use glue_options to get them from the parsed options"""
     parser.add_option("-z", "--zoom-levels", dest="zoom_levels", default="0:19",
                       help="Range of zoom levels to download, full is 0:19", metavar="Z0:Z1")
     
@@ -179,21 +430,89 @@ if __name__=="__main__":
                       help="Size of the square fragment to download. Not more than 640.")
     parser.add_option("", "--alpha-gradient-size", type=int, default=10,
                       help="Size of the alpha gradient for glueing pieces")
+    parser.add_option("", "--alpha-profile", dest="alpha_profile", default="linear", choices=sorted(alpha_profiles),
+                      help="Shape of the alpha gradient: linear (default) or cosine")
     #parser.add_option("-p", "--projection", dest="projection", default="orthogonal",
     #                  help="Projection type. Default is orthogonal. mercator is possible")
     parser.add_option("-w", "--width", dest="out_width", type=int, default=2048, metavar="PIXELS",
                       help="Width of the output image. Default is 2048.")
-    parser.add_option("", "--mesh-step", dest="mesh_step", type=int, default=8, metavar="PIXELS",
-                      help="Size of the mesh in the output image, used to interpolate distortion. Default is 8.")
+    add_render_options(parser, streaming=False)
+    parser.add_option("", "--strip-store", dest="strip_store", metavar="FOLDER",
+                      help="Folder to store transformed zoom levels. Re-runs with changed parameters render only the zoom levels, affected by the change.")
     parser.add_option("", "--cache-folder", dest="cache_folder",  metavar="FOLDER",
                       help="Path to the folder, used to store downloaded dataa. Useful to limit traffic use, if you are playing with settings.")
+    parser.add_option("", "--cache-size", dest="cache_size", type=float, metavar="MB",
+                      help="Maximal size of the cache. Least recently used fragments are removed. Default is unlimited.")
+    parser.add_option("", "--cache-raw", dest="cache_raw", action="store_true", default=False,
+                      help="Store decoded fragments in the cache too, to skip decoding on cache hits. Takes several times more space.")
+    parser.add_option("", "--connections", dest="connections", type=int, default=4, metavar="N",
+                      help="Number of concurrent connections for downloading. Default is 4.")
+    parser.add_option("", "--max-rate", dest="max_rate", type=float, metavar="REQUESTS",
+                      help="Maximal number of download requests per second. Default is unlimited.")
+    parser.add_option("", "--retries", dest="retries", type=int, default=3, metavar="N",
+                      help="Number of retries of the failed downloads. Default is 3.")
+    parser.add_option("", "--base-url", dest="base_url", metavar="URL",
+                      help="URL of the static maps API. Default is Google static maps, or LOGZOOM_MAP_URL environment variable")
+    parser.add_option("", "--full-fragments", dest="band_limited", action="store_false", default=True,
+                      help="Transform whole fragments, not only the rows, visible in the glued image.")
+    parser.add_option("", "--no-pipeline", dest="pipeline", action="store_false", default=True,
+                      help="Download, transform and glue zoom levels one by one, without overlapping.")
     parser.add_option("", "--bottom-margin", dest="bottom_margin", type=int, default=0, metavar="PIXELS",
                       help="Welll... Guess.")
 
+def parse_zoom_range(text):
+    """Parse zoom range Z0:Z1"""
+    z0, z1 = map(int, text.split(":"))
+    return z0, z1
+
+def open_fragment_cache(options):
+    """FragmentCache, configured by the options, added by add_glue_options, or None"""
+    if options.cache_folder is None: return None
+    return FragmentCache(options.cache_folder,
+                         max_bytes = None if options.cache_size is None else int(options.cache_size*2**20),
+                         raw = options.cache_raw)
+
+def open_client(options):
+    """MapClient, configured by the options, added by add_glue_options"""
+    return MapClient(connections=options.connections, max_rate=options.max_rate, retries=options.retries, base_url=options.base_url)
+
+def glue_options(options):
+    """Keyword arguments for the download_and_glue, from the options, added by add_glue_options. Zoom range and client are not included"""
+    kwargs = {"map_type": options.map_type.lower(),
+              "out_width": options.out_width,
+              "fragment_size": (options.fragment_size, options.fragment_size),
+              "alpha_gradient_size": options.alpha_gradient_size,
+              "alpha_profile": options.alpha_profile,
+              "margins": (0, options.bottom_margin, 0, 0),
+              "pipeline": options.pipeline,
+              "band_limited": options.band_limited,
+              "strip_store": None}
+    if options.strip_store:
+        from strip_store import StripStore
+        kwargs["strip_store"] = StripStore(options.strip_store)
+    kwargs.update(render_options(options))
+    return kwargs
+
+if __name__=="__main__":
+
+    from optparse import OptionParser
+    parser = OptionParser(usage = "%prog [options] LATITUDE LONGITUDE [OUTPUT]\n"
+                          "Create automatically glued, logarithmic map of a point.\n"
+                          "If OUTPUT has .dzi extension, DeepZoom tile pyramid is written, without keeping the whole image in memory.")
+
+    add_glue_options(parser)
+    parser.add_option("", "--tile-size", dest="tile_size", type=int, default=256, metavar="PIXELS",
+                      help="Size of the tiles of the .dzi output. Default is 256")
+    parser.add_option("", "--tile-format", dest="tile_format", default="png", choices=["png", "jpg"],
+                      help="Format of the tiles of the .dzi output: png (default) or jpg")
+    parser.add_option("", "--canvas-file", dest="canvas_file", metavar="FILE.npy",
+                      help="Glue the image in the memory-mapped file instead of memory, and encode it by strips. "
+                      "Output must be PNG file. The file is removed, when the output is written.")
+
     (options, args) = parser.parse_args()
     
     try:
-        z0, z1 = map(int, options.zoom_levels.split(":"))
+        z0, z1 = parse_zoom_range(options.zoom_levels)
     except Exception as e:
         parser.error("Failed to parse zoom range: {0}".format(e))
     
@@ -210,23 +529,33 @@ if __name__=="__main__":
     if len(args) > 3:
         parser.error("Too many arguments")
 
-    map_type = options.map_type.lower()
-    if not is_supported_map_type(map_type): parser.error("Bad map type: {0}".format(map_type))
+    if options.retries < 0: parser.error("Number of retries must not be negative")
+    glue_kwargs = glue_options(options)
+    if not is_supported_map_type(glue_kwargs["map_type"]): parser.error("Bad map type: {0}".format(glue_kwargs["map_type"]))
 
     if options.cache_folder is not None:
-        cache_folder = options.cache_folder
-        print ("Using cache {0}".format(cache_folder))
-        if not os.path.exists( cache_folder ):
-            print ("Cache path {0} does not exists. Creating it.".format(cache_folder))
-            os.makedirs(cache_folder)
-
-    img = download_and_glue( coordinates, zoom_range=(z0,z1),map_type=map_type,out_width=options.out_width, mesh_step=options.mesh_step,
-                             fragment_size=(options.fragment_size,options.fragment_size),
-                             margins=(0,options.bottom_margin,0,0))
+        print ("Using cache {0}".format(options.cache_folder))
+        fragment_cache = open_fragment_cache(options)
+
+    if options.canvas_file and (output is None or not output.lower().endswith(".png")):
+        parser.error("Canvas file requires PNG output file")
+
+    with open_client(options) as client:
+        if output is None:
+            img = download_and_glue( coordinates, zoom_range=(z0,z1), client=client, **glue_kwargs)
+        else:
+            glue_to_file( coordinates, (z0,z1), output, options.tile_size, options.tile_format, options.canvas_file,
+                          client=client, **glue_kwargs)
+    if fragment_cache is not None:
+        print (fragment_cache.summary())
+    if glue_kwargs["plan_cache"] is not None:
+        print (glue_kwargs["plan_cache"].summary())
+    if glue_kwargs["strip_store"] is not None:
+        print (glue_kwargs["strip_store"].summary())
     if output is None:
         img.show()
-    else:
-        img.save(output)
+    if options.stats:
+        instrument.save(options.stats)
         
 
 #59.937780 30.494908
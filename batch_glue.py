@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+"""Create glued logarithmic maps for many points, listed in a job file.
+Jobs are run by a pool of worker processes, sharing fragment and plan caches on disk.
+Every worker keeps its masks, connections and caches warm between the jobs.
+"""
+from auto_glue import download_and_glue, add_glue_options, glue_options, open_fragment_cache, open_client, parse_zoom_range
+from gmap_get import is_supported_map_type
+from contextlib import redirect_stdout
+import multiprocessing
+import instrument
+import auto_glue
+import json
+import sys
+import time
+import csv
+import os
+
+def read_jobs(path, default_zooms, default_map_type):
+    """Read jobs from CSV file (with header) or JSONL file (one JSON object per line).
+    Fields: lat, lon, output; optional: zooms (Z0:Z1, or list [z0, z1]) and map_type.
+    Returns list of job dictionaries. Raises ValueError with line number, if the file is malformed.
+    """
+    with open(path) as job_file:
+        if path.lower().endswith(".csv"):
+            records = [(i+2, row) for i, row in enumerate(csv.DictReader(job_file))]
+        else:
+            records = []
+            for line_number, line in enumerate(job_file, 1):
+                if not line.strip(): continue
+                try:
+                    records.append((line_number, json.loads(line)))
+                except ValueError as err:
+                    raise ValueError("Line {0}: {1}".format(line_number, err))
+    jobs = []
+    for line_number, record in records:
+        try:
+            zooms = record.get("zooms") or default_zooms
+            if isinstance(zooms, str):
+                zooms = parse_zoom_range(zooms)
+            job = {"lat": float(record["lat"]),
+                   "lon": float(record["lon"]),
+                   "zooms": tuple(int(z) for z in zooms),
+                   "map_type": (record.get("map_type") or default_map_type).lower(),
+                   "output": record["output"]}
+        except (KeyError, TypeError, ValueError) as err:
+            raise ValueError("Line {0}: bad job {1}: {2}".format(line_number, record, err))
+        if len(job["zooms"]) != 2:
+            raise ValueError("Line {0}: bad zoom range {1}".format(line_number, zooms))
+        if not is_supported_map_type(job["map_type"]):
+            raise ValueError("Line {0}: bad map type {1}".format(line_number, job["map_type"]))
+        jobs.append(job)
+    return jobs
+
+#State of the worker process, created by _init_worker
+_worker_client = None
+_worker_glue_kwargs = None
+_worker_verbose = False
+
+def _init_worker(options, verbose):
+    global _worker_client, _worker_glue_kwargs, _worker_verbose
+    if multiprocessing.parent_process() is not None:
+        #Values and subscribers, inherited from the parent, are handled there; jobs report their values in the summary.
+        instrument.reset(forget_subscribers=True)
+    auto_glue.fragment_cache = open_fragment_cache(options)
+    _worker_glue_kwargs = glue_options(options)
+    _worker_client = open_client(options)
+    _worker_verbose = verbose
+
+def _partial_path(output):
+    base, ext = os.path.splitext(output)
+    return base + ".partial" + ext
+
+def run_job(job):
+    """Run one job in the worker. Returns the job summary: job fields, status, time, network statistics,
+    and instrumentation values, collected during the job (see instrument.snapshot)"""
+    client = _worker_client
+    cache = auto_glue.fragment_cache
+    requests_before, bytes_before = client.requests, client.bytes_downloaded
+    hits_before = cache.hits if cache is not None else 0
+    summary = dict(job)
+    partial = _partial_path(job["output"])
+    stats_before = instrument.snapshot()
+    t0 = time.monotonic()
+    try:
+        kwargs = dict(_worker_glue_kwargs, map_type=job["map_type"])
+        with open(os.devnull, "w") as devnull, redirect_stdout(sys.stdout if _worker_verbose else devnull):
+            img = download_and_glue((job["lat"], job["lon"]), zoom_range=job["zooms"], client=client, **kwargs)
+        #Write to the temporary file first, so that interrupted jobs don't leave outputs, that look complete
+        output_dir = os.path.dirname(job["output"])
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        with instrument.stage("encode"):
+            img.save(partial)
+        os.replace(partial, job["output"])
+        summary["status"] = "done"
+    except Exception as err:
+        summary["status"] = "failed"
+        summary["error"] = "{0}: {1}".format(type(err).__name__, err)
+        if os.path.exists(partial):
+            os.unlink(partial)
+    summary["seconds"] = time.monotonic() - t0
+    summary["requests"] = client.requests - requests_before
+    summary["bytes_downloaded"] = client.bytes_downloaded - bytes_before
+    if cache is not None:
+        summary["cache_hits"] = cache.hits - hits_before
+    summary["stats"] = instrument.difference(instrument.snapshot(), stats_before)
+    return summary
+
+def run_batch(jobs, options, workers=1, summary_file=None, verbose=False):
+    """Run jobs, by a pool of worker processes if workers > 1. Generates job summaries in order of completion.
+    Summaries are also appended to the summary_file (JSON lines), if given.
+    """
+    if workers > 1:
+        try:
+            context = multiprocessing.get_context("fork")
+        except ValueError:
+            context = multiprocessing.get_context()
+        pool = context.Pool(workers, initializer=_init_worker, initargs=(options, verbose))
+        results = pool.imap_unordered(run_job, jobs)
+    else:
+        pool = None
+        _init_worker(options, verbose)
+        results = map(run_job, jobs)
+    try:
+        for summary in results:
+            if pool is not None:
+                instrument.merge(summary["stats"])
+            if summary_file is not None:
+                summary_file.write(json.dumps(summary) + "\n")
+                summary_file.flush()
+            yield summary
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        elif _worker_client is not None:
+            _worker_client.close()
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage = "%prog [options] JOBS_FILE\n"
+                          "Create automatically glued, logarithmic maps for many points.\n"
+                          "JOBS_FILE is CSV (with header) or JSONL with fields: lat, lon, output, and optional zooms (Z0:Z1) and map_type.\n"
+                          "Jobs with existing outputs are skipped, so interrupted batch can be resumed by running it again.")
+    add_glue_options(parser)
+    parser.add_option("", "--workers", dest="workers", type=int, default=1, metavar="N",
+                      help="Number of worker processes, running the jobs. Default is 1")
+    parser.add_option("", "--summary", dest="summary", metavar="FILE.jsonl",
+                      help="File, where timing summary of every job is appended. Default is JOBS_FILE.summary.jsonl")
+    parser.add_option("-f", "--force", dest="force", action="store_true", default=False,
+                      help="Run all jobs, even if their outputs exist")
+    parser.add_option("-v", "--verbose", dest="verbose", action="store_true", default=False,
+                      help="Show progress of the individual jobs")
+    (options, args) = parser.parse_args()
+    if len(args) != 1: parser.error("One job file expected")
+    if options.workers > 1 and options.jobs > 1:
+        parser.error("Worker processes can not render in parallel: use either --workers or --jobs")
+    if options.retries < 0: parser.error("Number of retries must not be negative")
+
+    try:
+        default_zooms = parse_zoom_range(options.zoom_levels)
+    except Exception as e:
+        parser.error("Failed to parse zoom range: {0}".format(e))
+    try:
+        jobs = read_jobs(args[0], default_zooms, options.map_type)
+    except (IOError, ValueError) as err:
+        parser.error("Failed to read jobs: {0}".format(err))
+
+    pending = [job for job in jobs if options.force or not os.path.exists(job["output"])]
+    print ("Jobs: {0}, already done: {1}".format(len(jobs), len(jobs)-len(pending)))
+    if not pending: return
+
+    summary_path = options.summary or args[0] + ".summary.jsonl"
+    t0 = time.monotonic()
+    done = failed = 0
+    with open(summary_path, "a") as summary_file:
+        for i, summary in enumerate(run_batch(pending, options, options.workers, summary_file, options.verbose), 1):
+            if summary["status"] == "done":
+                done += 1
+                print ("[{0}/{1}] {output}: {seconds:.1f}s, {requests} requests".format(i, len(pending), **summary))
+            else:
+                failed += 1
+                print ("[{0}/{1}] {output}: FAILED after {seconds:.1f}s: {error}".format(i, len(pending), **summary))
+    elapsed = time.monotonic() - t0
+    print ("Finished {0} jobs in {1:.1f}s ({2:.1f}s per job), {3} failed. Summary is in {4}".format(
+        done, elapsed, elapsed / max(1, done+failed), failed, summary_path))
+    if options.stats:
+        instrument.save(options.stats)
+
+if __name__=="__main__": main()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+"""Benchmark suite: meshes, transforms, masks, downloading and glueing.
+All inputs are synthetic, map fragments are served by the local stub map server (map_stub_server.py).
+Results are saved as JSON, and can be compared with a stored baseline to find regressions.
+"""
+from map_stub_server import StubMapServer
+from fragment_cache import FragmentCache
+from gmap_get import MapClient
+from image_distort import make_mesh_for_domain, make_mesh_vectorized, transform_image
+from log_transform import logpolar_transform
+from invlog_transform import inv_logpolar_transform
+from mercator2ortho import mercator2ortho
+from collections import OrderedDict
+from contextlib import redirect_stdout, contextmanager
+from PIL import Image
+from math import *
+import numpy as np
+import auto_glue
+import platform
+import tempfile
+import shutil
+import time
+import sys
+import json
+import PIL
+import os
+
+def measure(func, repeat=3):
+    """Best of repeat running times of the function, seconds"""
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+@contextmanager
+def quiet():
+    """Context, hiding progress messages of the library functions"""
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        yield
+
+def synthetic_image(size, seed=0):
+    """Random RGBA noise, smoothed a bit so that it looks like an image for the resampling filters"""
+    noise = np.random.RandomState(seed).randint(0, 256, (size[1]//4+1, size[0]//4+1, 4)).astype(np.uint8)
+    return Image.fromarray(noise, "RGBA").resize(size, Image.BILINEAR)
+
+def bench_meshes(options):
+    results = OrderedDict()
+    for out_width, out_height in ((512, 256), (1024, 512)):
+        _, tfm = logpolar_transform((out_width, out_width), None, out_width=out_width, out_height=out_height)
+        for mesh_step in (4, 8, 16):
+            case = "{0}x{1},step={2}".format(out_width, out_height, mesh_step)
+            results["mesh_for_domain/" + case] = measure(
+                lambda: list(make_mesh_for_domain(tfm, out_width, out_height, mesh_step)), options.repeat)
+            results["mesh_vectorized/" + case] = measure(
+                lambda: make_mesh_vectorized(tfm.vectorized, out_width, out_height, mesh_step), options.repeat)
+    return results
+
+def _transforms(source_size, out_width):
+    """Named test transforms: (out_size, tfm)"""
+    out_size, logpolar = logpolar_transform(source_size, None, out_width=out_width)
+    invlog = inv_logpolar_transform(source_size, 0, out_width, out_width)
+    ortho_size, merc2ortho, _ = mercator2ortho(source_size, radians(55.0), radians(20.0), out_width)
+    return OrderedDict([("logpolar", (out_size, logpolar)),
+                        ("invlog", ((out_width, out_width), invlog)),
+                        ("mercator2ortho", (ortho_size, merc2ortho))])
+
+def remap_alpha_error(resample, size=256):
+    """Largest difference of the remap engine from the mesh transform with 1-pixel step, on the source with varying alpha.
+    Images are compared with premultiplied alpha, the way Image.transform interpolates them:
+    straight colors of almost transparent pixels are only defined up to the rounding, multiplied by 255/alpha.
+    """
+    source = synthetic_image((size, size), seed=1)
+    out_size, tfm = logpolar_transform(source.size, None, out_width=size)
+    mesh, remap = [np.asarray(transform_image(source, tfm, out_size, 1, engine=engine, resample=resample).convert("RGBa"))
+                   for engine in ("mesh", "remap")]
+    return int(np.abs(mesh.astype(int) - remap).max())
+
+def bench_transforms(options):
+    results = OrderedDict()
+    for name, resample in (("bilinear", Image.BILINEAR), ("bicubic", Image.BICUBIC)):
+        error = remap_alpha_error(resample)
+        print ("  remap/mesh difference, {0}: {1}".format(name, error))
+        if error > 2:
+            raise RuntimeError("Remap engine does not match the mesh transform: difference {0}".format(error))
+    source = synthetic_image((1024, 1024))
+    for name, (out_size, tfm) in _transforms(source.size, 1024).items():
+        for engine in ("mesh", "remap"):
+            results["transform/{0},{1}".format(name, engine)] = measure(
+                lambda: transform_image(source, tfm, out_size, 8, engine=engine), options.repeat)
+        results["transform/{0},adaptive".format(name)] = measure(
+            lambda: transform_image(source, tfm, out_size, 32, mesh_tolerance=0.5), options.repeat)
+    return results
+
+def bench_alpha(options):
+    results = OrderedDict()
+    for size in (512, 1280):
+        for profile in ("linear", "cosine"):
+            def make():
+                #Measure building of the mask, not the memoized lookup
+                auto_glue._alpha_array.cache_clear()
+                auto_glue.make_alpha((size, size), 10, (0, 20, 0, 0), profile)
+            results["make_alpha/{0},{1}".format(size, profile)] = measure(make, options.repeat)
+    return results
+
+def bench_fetch(server, coordinates, zooms, fragment_size=(512,512), map_type="satellite", scale=2,
+                connections=4, retries=5, cache=None):
+    """Download fragments of all zooms through the server. Returns dictionary of measurements"""
+    auto_glue.fragment_cache = cache
+    t0 = time.monotonic()
+    with MapClient(connections=connections, retries=retries, backoff=0.05, base_url=server.url) as client:
+        with quiet():
+            fragments = auto_glue.fetch_fragments(coordinates, zooms, fragment_size, map_type, scale, client)
+    elapsed = time.monotonic() - t0
+    return {"connections": connections,
+            "cached": cache is not None,
+            "fragments": len(fragments),
+            "seconds": elapsed,
+            "fragments_per_second": len(fragments) / elapsed,
+            "requests": client.requests,
+            "retried": client.retried,
+            "bytes": client.bytes_downloaded}
+
+def format_fetch_result(result):
+    return ("connections={connections:<3d} cached={cached!s:<5} {seconds:7.3f}s {fragments_per_second:7.1f} fragments/s "
+            "requests={requests} retried={retried} bytes={bytes}").format(**result)
+
+def _stub_server(options):
+    return StubMapServer(latency=options.latency, error_rate=options.error_rate,
+                         bandwidth=options.bandwidth and options.bandwidth*1024, seed=options.seed)
+
+def bench_fetching(options):
+    """Concurrent downloading with different numbers of connections, then cold and warm fragment cache"""
+    results = OrderedDict()
+    coordinates = (55.7523, 37.6231)
+    zooms = list(range(options.fragments))
+    with _stub_server(options) as server:
+        for connections in options.connection_counts:
+            result = bench_fetch(server, coordinates, zooms, scale=options.scale, connections=connections)
+            print ("  " + format_fetch_result(result))
+            results["fetch/connections={0}".format(connections)] = result["seconds"]
+        cache_folder = tempfile.mkdtemp(prefix="logzoom-bench-")
+        try:
+            cache = FragmentCache(cache_folder, raw=options.cache_raw)
+            #First pass fills the cache, second one must not touch the network
+            for name in ("cold", "warm"):
+                result = bench_fetch(server, coordinates, zooms, scale=options.scale,
+                                     connections=max(options.connection_counts), cache=cache)
+                print ("  " + format_fetch_result(result))
+                results["fetch/cache,{0}".format(name)] = result["seconds"]
+        finally:
+            auto_glue.fragment_cache = None
+            shutil.rmtree(cache_folder)
+    return results
+
+def bench_glue(options):
+    """Full download_and_glue, against the stub server"""
+    results = OrderedDict()
+    with _stub_server(options) as server:
+        for pipeline in (False, True):
+            def glue():
+                with MapClient(connections=4, retries=5, backoff=0.05, base_url=server.url) as client, quiet():
+                    auto_glue.download_and_glue((55.7523, 37.6231), zoom_range=(0, options.fragments-1), out_width=1024,
+                                                fragment_size=(256, 256), scale=options.scale, client=client, pipeline=pipeline)
+            results["glue/{0}".format("pipeline" if pipeline else "sequential")] = measure(glue, options.repeat)
+    return results
+
+benchmarks = OrderedDict([("mesh", bench_meshes),
+                          ("transform", bench_transforms),
+                          ("alpha", bench_alpha),
+                          ("fetch", bench_fetching),
+                          ("glue", bench_glue)])
+
+def environment():
+    return {"python": platform.python_version(),
+            "numpy": np.__version__,
+            "pillow": PIL.__version__,
+            "machine": platform.machine(),
+            "system": platform.system()}
+
+def compare(results, baseline, threshold):
+    """Compare times with the baseline. Returns list of regressed benchmark names"""
+    regressions = []
+    for name, seconds in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print ("{0:<45} {1:9.4f}s  (new)".format(name, seconds))
+            continue
+        ratio = seconds / base if base else float("inf")
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print ("{0:<45} {1:9.4f}s  baseline {2:9.4f}s  {3:+6.1%}{4}".format(name, seconds, base, ratio-1, flag))
+    return regressions
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage = "%prog [options] [BENCHMARK ...]\n"
+                          "Run benchmarks: {0}. By default, all are run.".format(", ".join(benchmarks)))
+    parser.add_option("-r", "--repeat", dest="repeat", type=int, default=3,
+                      help="Number of repetitions of every measurement; best time is taken. Default is 3")
+    parser.add_option("-o", "--output", dest="output", metavar="FILE.json",
+                      help="Write results to the JSON file")
+    parser.add_option("-b", "--baseline", dest="baseline", metavar="FILE.json",
+                      help="Compare results with the baseline, saved by the --output option")
+    parser.add_option("", "--threshold", dest="threshold", type=float, default=0.2, metavar="FRACTION",
+                      help="Slowdown relative to the baseline, that is reported as a regression. Default is 0.2")
+    parser.add_option("-c", "--connections", dest="connections", default="1,2,4,8",
+                      help="Comma-separated list of connection counts for the fetch benchmark. Default is 1,2,4,8")
+    parser.add_option("-n", "--fragments", dest="fragments", type=int, default=10,
+                      help="Number of fragments (zoom levels) to download and glue. Default is 10")
+    parser.add_option("", "--latency", dest="latency", type=float, default=0.05, metavar="SECONDS",
+                      help="Average response delay of the stub server. Default is 0.05")
+    parser.add_option("", "--error-rate", dest="error_rate", type=float, default=0.0, metavar="FRACTION",
+                      help="Fraction of failed stub server responses")
+    parser.add_option("", "--bandwidth", dest="bandwidth", type=float, metavar="KB_PER_SECOND",
+                      help="Transfer rate of every stub server response. Default is unlimited")
+    parser.add_option("", "--scale", dest="scale", type=int, default=2,
+                      help="Scale of the fragments, 1 or 2. Default is 2")
+    parser.add_option("", "--cache-raw", dest="cache_raw", action="store_true", default=False,
+                      help="Store raw pixels in the fragment cache")
+    parser.add_option("", "--seed", dest="seed", type=int, default=0,
+                      help="Random seed of the stub server")
+    (options, args) = parser.parse_args()
+    for name in args:
+        if name not in benchmarks: parser.error("Unknown benchmark: {0}".format(name))
+    try:
+        options.connection_counts = [int(c) for c in options.connections.split(",")]
+    except ValueError:
+        parser.error("Bad connection counts: {0}".format(options.connections))
+    baseline = None
+    if options.baseline:
+        try:
+            with open(options.baseline) as baseline_file:
+                baseline = json.load(baseline_file)["results"]
+        except (IOError, ValueError, KeyError) as err:
+            parser.error("Failed to read baseline: {0}".format(err))
+
+    results = OrderedDict()
+    for name in (args or benchmarks):
+        print ("Running {0}...".format(name))
+        results.update(benchmarks[name](options))
+
+    if baseline is None:
+        for name, seconds in results.items():
+            print ("{0:<45} {1:9.4f}s".format(name, seconds))
+        regressions = []
+    else:
+        regressions = compare(results, baseline, options.threshold)
+        if regressions:
+            print ("{0} regressions found".format(len(regressions)))
+
+    if options.output:
+        with open(options.output, "w") as output_file:
+            json.dump({"environment": environment(), "repeat": options.repeat, "results": results},
+                      output_file, indent=2)
+    if regressions:
+        sys.exit(1)
+
+if __name__=="__main__": main()
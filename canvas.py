@@ -0,0 +1,149 @@
+"""Canvases, where transformed fragments are glued.
+
+Canvas receives fragments with composite(img, offset), and is told with finish_rows(y), that the rows above y will not change.
+close() completes the canvas and returns the result.
+    ImageCanvas - the whole image in memory.
+    StripCanvas - keeps only the unfinished rows, and writes finished ones to the strip writer (see png_stream.PNGStripWriter).
+    MemmapCanvas - the whole image in the memory-mapped file, only the unfinished rows are kept in memory.
+"""
+from PIL import Image
+import numpy as np
+import instrument
+import mmap
+
+def _visible_box(img, offset, bg_size):
+    """Bounding box of the non-transparent part of the image, clipped by the background of the given size, or None if it is empty"""
+    bbox = img.getbbox() #of the alpha channel
+    if bbox is None: return None
+    ox, oy = offset
+    x0, y0 = max(bbox[0], -ox), max(bbox[1], -oy)
+    x1, y1 = min(bbox[2], bg_size[0]-ox), min(bbox[3], bg_size[1]-oy)
+    if x0 < x1 and y0 < y1:
+        return x0, y0, x1, y1
+    return None
+
+def paste_with_alpha(bg, img, offset):
+    """Composite RGBA image over the RGBA background in place, with the "over" operator, so that alpha of the result is correct.
+    Only the bounding box of the non-transparent part of the image, clipped by the background, is blended.
+    """
+    box = _visible_box(img, offset, bg.size)
+    if box is not None:
+        bg.alpha_composite(img, (offset[0]+box[0], offset[1]+box[1]), box)
+    return bg
+
+class ImageCanvas:
+    """RGBA image of the given size in memory. close() returns the image"""
+    def __init__(self, size):
+        self.size = size
+        self.image = Image.new("RGBA", size)
+
+    def composite(self, img, offset):
+        paste_with_alpha(self.image, img, offset)
+
+    def finish_rows(self, y):
+        pass
+
+    def close(self):
+        return self.image
+
+class StripCanvas:
+    """Canvas, that keeps in memory only the rows, that can still change.
+    Finished rows are passed to writer.write_strip(y0, strip) from top to bottom, as soon as they are known.
+    Writer is not closed by the canvas. close() writes the remaining rows and returns None.
+    """
+    def __init__(self, size, writer):
+        self.size = size
+        self.writer = writer
+        #Buffer holds the rows top...top+buffer height
+        self.top = 0
+        self.buffer = Image.new("RGBA", (size[0], 0))
+
+    def _extend(self, bottom):
+        """Make buffer hold the rows up to the bottom"""
+        bottom = min(bottom, self.size[1])
+        if bottom <= self.top + self.buffer.size[1]: return
+        buffer = Image.new("RGBA", (self.size[0], bottom - self.top))
+        buffer.paste(self.buffer, (0, 0))
+        self.buffer = buffer
+
+    def composite(self, img, offset):
+        ox, oy = offset
+        if oy < self.top:
+            raise ValueError("Row {0} is already finished".format(oy))
+        self._extend(oy + img.size[1])
+        paste_with_alpha(self.buffer, img, (ox, oy - self.top))
+
+    def finish_rows(self, y):
+        y = min(y, self.size[1])
+        if y <= self.top: return
+        self._extend(y)
+        rows = y - self.top
+        with instrument.stage("encode"):
+            self.writer.write_strip(self.top, self.buffer.crop((0, 0, self.size[0], rows)))
+        self.buffer = self.buffer.crop((0, rows, self.size[0], self.buffer.size[1]))
+        self.top = y
+
+    def close(self):
+        self.finish_rows(self.size[1])
+
+class MemmapCanvas:
+    """Canvas in the memory-mapped .npy file (HxWx4 array of RGBA pixels), for images, that don't fit in memory.
+    Fragments are composited by the regions they cover. Finished rows are written to the file and released from memory,
+    so only the unfinished rows stay resident.
+    close() returns the canvas itself; the image is then encoded by strips (write_strips, save).
+    File can also be opened later with np.load(path, mmap_mode="r").
+    """
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        width, height = size
+        self.array = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=(height, width, 4))
+        self.rows_released = 0
+
+    def composite(self, img, offset):
+        box = _visible_box(img, offset, self.size)
+        if box is None: return
+        x0, y0, x1, y1 = box
+        ox, oy = offset
+        region = self.array[oy+y0:oy+y1, ox+x0:ox+x1]
+        bg = Image.fromarray(np.array(region), "RGBA")
+        bg.alpha_composite(img, (0, 0), box)
+        region[...] = np.asarray(bg)
+
+    def _release(self, y0, y1):
+        """Write rows y0...y1 to the file, and drop their pages from memory"""
+        if y1 <= y0: return
+        self.array.flush()
+        mapping = getattr(self.array, "_mmap", None)
+        if mapping is None or not hasattr(mmap, "MADV_DONTNEED"): return
+        #Mapping starts at the allocation granularity boundary before the array data
+        base = self.array.offset % mmap.ALLOCATIONGRANULARITY
+        row_bytes = self.size[0] * 4
+        start = -(-(base + y0*row_bytes) // mmap.PAGESIZE) * mmap.PAGESIZE
+        end = (base + y1*row_bytes) // mmap.PAGESIZE * mmap.PAGESIZE
+        if start < end:
+            mapping.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+    def finish_rows(self, y):
+        y = min(y, self.size[1])
+        self._release(self.rows_released, y)
+        self.rows_released = max(self.rows_released, y)
+
+    def close(self):
+        self.array.flush()
+        return self
+
+    def write_strips(self, writer, strip_height=256):
+        """Pass the image to writer.write_strip(y0, strip) by strips of rows (see png_stream.PNGStripWriter)"""
+        for y0 in range(0, self.size[1], strip_height):
+            y1 = min(self.size[1], y0 + strip_height)
+            writer.write_strip(y0, np.asarray(self.array[y0:y1]))
+            self._release(y0, y1)
+
+    def save(self, path, strip_height=256):
+        """Encode the image to the PNG file by strips"""
+        from png_stream import PNGStripWriter
+        if not path.lower().endswith(".png"):
+            raise ValueError("Only PNG output can be encoded by strips")
+        with PNGStripWriter(path, self.size, "RGBA") as writer:
+            self.write_strips(writer, strip_height)
@@ -0,0 +1,244 @@
+"""Disk cache of the downloaded map fragments, with size limit and LRU eviction"""
+from PIL import Image
+from collections import OrderedDict
+from io import BytesIO
+import numpy as np
+import instrument
+import gmap_get
+import threading
+import tempfile
+import hashlib
+import json
+import time
+import os
+try:
+    import fcntl
+except ImportError:
+    #No inter-process locking on this platform
+    fcntl = None
+
+class FragmentCache:
+    """Cache of map fragments in a folder.
+
+    Every fragment is stored as PNG file, named by the hash of the request parameters.
+    The index file (index.json) keeps parameters and sizes of the entries; when total size exceeds max_bytes,
+    least recently used entries are removed. Access time of the entry is the modification time of its PNG file,
+    which is updated on every hit, so hits don't rewrite the index.
+    Files are written atomically (temporary file, then rename), and the index is updated under a file lock,
+    so several processes can share the cache. Reading does not lock: the index is re-read only when its file is replaced.
+    raw: also store decoded RGBA pixels. Raw files are memory-mapped on hit, so no PNG decoding is needed.
+    """
+    index_name = "index.json"
+
+    def __init__(self, folder, max_bytes=None, raw=False):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.raw = raw
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        #Last read index and the (inode, modification time, size) of its file
+        self.index = ({}, None)
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def key(coordinates, zoom, fragment_size, map_type, scale, base_url=None):
+        """Canonical key of the fragment request. base_url: URL of the map server, default is gmap_get.map_api_url"""
+        lat, lon = coordinates
+        width, height = fragment_size
+        url = base_url or gmap_get.map_api_url
+        params = "{lat:0.7f},{lon:0.7f},{zoom:d},{width:d}x{height:d},{map_type},{scale:d},{url}".format(**locals())
+        return hashlib.sha1(params.encode("utf-8")).hexdigest(), params
+
+    def _path(self, name):
+        return os.path.join(self.folder, name)
+
+    def _read_index(self):
+        """Current index, for reading only. It is loaded again only if the index file has changed"""
+        try:
+            stat = os.stat(self._path(self.index_name))
+        except OSError:
+            return {}
+        version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        index, index_version = self.index
+        if index_version != version:
+            try:
+                with open(self._path(self.index_name)) as index_file:
+                    index = json.load(index_file)
+            except (IOError, ValueError):
+                index = {}
+            self.index = (index, version)
+        return index
+
+    def _locked_index(self, update):
+        """Read index, pass it to update function, and write it back if update returns True. Used only to change the index"""
+        with self.lock, open(self._path("index.lock"), "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(self._path(self.index_name)) as index_file:
+                    index = json.load(index_file)
+            except (IOError, ValueError):
+                index = {}
+            if update(index):
+                self._write_atomic(self.index_name, json.dumps(index, indent=0).encode("utf-8"))
+
+    def _write_atomic(self, name, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                tmp_file.write(data)
+            os.replace(tmp_path, self._path(name))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _lookup(self, key):
+        """Find the entry and update its access time. Returns the entry or None"""
+        entry = self._read_index().get(key)
+        if entry is not None:
+            try:
+                #Entry may be evicted by another process at any moment
+                os.utime(self._path(entry["files"][0]))
+                if not all(os.path.exists(self._path(name)) for name in entry["files"][1:]):
+                    entry = None
+            except OSError:
+                entry = None
+        with self.lock:
+            if entry is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        instrument.count("fragment_cache_misses" if entry is None else "fragment_cache_hits")
+        return entry
+
+    def _access_time(self, entry):
+        try:
+            return max(entry["atime"], os.path.getmtime(self._path(entry["files"][0])))
+        except OSError:
+            return entry["atime"]
+
+    def get_data(self, key):
+        """PNG data of the cached fragment, or None"""
+        entry = self._lookup(key[0])
+        if entry is None: return None
+        with open(self._path(entry["files"][0]), "rb") as png_file:
+            return png_file.read()
+
+    def get_image(self, key):
+        """Cached fragment as RGBA image, or None. Raw entries are memory-mapped, and the image is read-only"""
+        entry = self._lookup(key[0])
+        if entry is None: return None
+        if len(entry["files"]) > 1:
+            width, height = entry["size"]
+            pixels = np.memmap(self._path(entry["files"][1]), dtype=np.uint8, mode="r", shape=(height, width, 4))
+            return Image.frombuffer("RGBA", (width, height), pixels, "raw", "RGBA", 0, 1)
+        with open(self._path(entry["files"][0]), "rb") as png_file:
+            return Image.open(BytesIO(png_file.read())).convert("RGBA")
+
+    def put(self, key, data):
+        """Store PNG data of the fragment. If raw storage is enabled, returns decoded RGBA image, otherwise None"""
+        key, params = key
+        files = [key + ".png"]
+        self._write_atomic(files[0], data)
+        image = None
+        entry = {"params": params, "bytes": len(data)}
+        if self.raw:
+            image = Image.open(BytesIO(data)).convert("RGBA")
+            files.append(key + ".rgba")
+            self._write_atomic(files[1], image.tobytes())
+            entry["size"] = image.size
+            entry["bytes"] += image.size[0]*image.size[1]*4
+        entry["files"] = files
+
+        def add(index):
+            entry["atime"] = time.time()
+            index[key] = entry
+            self._evict(index, keep=key)
+            return True
+        self._locked_index(add)
+        return image
+
+    def _evict(self, index, keep=None):
+        if self.max_bytes is None: return
+        total = sum(entry["bytes"] for entry in index.values())
+        if total <= self.max_bytes: return
+        for old_key in sorted(index, key=lambda k: self._access_time(index[k])):
+            if total <= self.max_bytes: break
+            if old_key == keep: continue
+            for name in index[old_key]["files"]:
+                try:
+                    os.unlink(self._path(name))
+                except OSError:
+                    pass
+            total -= index.pop(old_key)["bytes"]
+
+    def total_bytes(self):
+        return sum(entry["bytes"] for entry in self._read_index().values())
+
+    def summary(self):
+        requests = self.hits + self.misses
+        return "Cache: {0} hits, {1} misses ({2:.0%} hit rate)".format(
+            self.hits, self.misses, self.hits / requests if requests else 0)
+
+class MemoryFragmentCache:
+    """Cache of map fragments in memory, with the same interface as FragmentCache, for long-running processes.
+    Keeps PNG data (and decoded RGBA images, if raw) of the recently used fragments, up to max_bytes in total.
+    """
+    def __init__(self, max_bytes=256*2**20, raw=False):
+        self.max_bytes = max_bytes
+        self.raw = raw
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        #key -> (data, image, bytes), in order of use
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+    key = staticmethod(FragmentCache.key)
+
+    def _lookup(self, key):
+        with self.lock:
+            entry = self.entries.get(key[0])
+            if entry is None:
+                self.misses += 1
+            else:
+                self.entries.move_to_end(key[0])
+                self.hits += 1
+        instrument.count("fragment_cache_misses" if entry is None else "fragment_cache_hits")
+        return entry
+
+    def get_data(self, key):
+        """PNG data of the cached fragment, or None"""
+        entry = self._lookup(key)
+        return entry and entry[0]
+
+    def get_image(self, key):
+        """Cached fragment as a new RGBA image, or None"""
+        entry = self._lookup(key)
+        if entry is None: return None
+        data, image, _ = entry
+        return image.copy() if image is not None else Image.open(BytesIO(data)).convert("RGBA")
+
+    def put(self, key, data):
+        """Store PNG data of the fragment. If raw storage is enabled, returns decoded RGBA image, otherwise None"""
+        image = Image.open(BytesIO(data)).convert("RGBA") if self.raw else None
+        size = len(data) + (image.size[0]*image.size[1]*4 if image is not None else 0)
+        with self.lock:
+            old = self.entries.pop(key[0], None)
+            if old is not None:
+                self.bytes -= old[2]
+            self.entries[key[0]] = (data, image, size)
+            self.bytes += size
+            while self.max_bytes is not None and self.bytes > self.max_bytes and len(self.entries) > 1:
+                _, (_, _, old_size) = self.entries.popitem(last=False)
+                self.bytes -= old_size
+        return image and image.copy()
+
+    def total_bytes(self):
+        return self.bytes
+
+    def summary(self):
+        requests = self.hits + self.misses
+        return "Cache: {0} hits, {1} misses ({2:.0%} hit rate)".format(
+            self.hits, self.misses, self.hits / requests if requests else 0)
@@ -1,7 +1,17 @@
 #!/usr/bin/env python
 from os.path import splitext
+import os
 from urllib.request import urlopen
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+import http.client
+import threading
+import random
 import shutil
+import queue
+import time
+import sys
+import instrument
 #     Use google static api
 #     Explanations: https://developers.google.com/maps/documentation/staticmaps/index
 #     http://maps.googleapis.com/maps/api/staticmap?center=-15.800513,-47.91378&zoom=13&size=800x800&sensor=false
@@ -15,7 +25,12 @@ __ext2format={".png": "png",
               ".jpeg": "jpg",
               ".gif": "gif"}
 
-def get_map_stream( center, zoom, size, type, format, scale=1 ):
+#Default URL of the static maps API. Can be overridden by the LOGZOOM_MAP_URL environment variable,
+#e.g. to use local map_stub_server.
+map_api_url = os.environ.get("LOGZOOM_MAP_URL", "http://maps.googleapis.com/maps/api/staticmap")
+
+def map_url( center, zoom, size, type, format, scale=1, base_url=None ):
+    """URL of the static map image. base_url: URL of the static maps API, default is map_api_url"""
     if format is None: raise ValueError("Format not specified")
     w,h = size
     if max(w,h) >640:
@@ -28,25 +43,160 @@ def get_map_stream( center, zoom, size, type, format, scale=1 ):
             "type": str(type),
             "format": format,
             "scale":scale}
-    url = "http://maps.googleapis.com/maps/api/staticmap?"\
+    return (base_url or map_api_url) + "?"\
           "center={lattitude:0.10f},{longitude:0.10f}&"\
           "zoom={zoom:d}&size={width:d}x{height:d}&scale={scale:d}&"\
           "maptype={type:s}&sensor=false&format={format:s}".format(**args)
-    return urlopen( url )
+
+def get_map_stream( center, zoom, size, type, format, scale=1, base_url=None ):
+    return urlopen( map_url(center, zoom, size, type, format, scale, base_url) )
+
+class MapFetchError(IOError):
+    pass
+
+class MapClient:
+    """Downloads map images through a pool of persistent HTTP connections.
+    connections: number of connections, and of the concurrent requests.
+    max_rate: maximal number of requests per second (None - unlimited).
+    retries: how many times failed request is repeated. Network errors, HTTP 429 and 5xx are retried; 
+      delay before the retry grows exponentially from the backoff seconds.
+    base_url: URL of the static maps API, default is map_api_url.
+    Attributes requests, retried and bytes_downloaded count the network activity.
+
+    Usage:
+      with MapClient(connections=4) as client:
+          images = client.fetch_many([ {"center":(lat,lon), "zoom":z, "size":(512,512)} for z in range(10) ])
+    """
+    def __init__(self, connections=4, max_rate=None, retries=3, backoff=0.5, timeout=30, base_url=None):
+        if retries < 0: raise ValueError("Number of retries must not be negative: {0}".format(retries))
+        self.connections = connections
+        self.base_url = base_url
+        self.requests = 0
+        self.retried = 0
+        self.bytes_downloaded = 0
+        self.min_interval = 1.0/max_rate if max_rate else 0.0
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.pool = queue.Queue()
+        self.pool_size = 0
+        self.lock = threading.Lock()
+        self.next_request_time = 0.0
+        self.executor = None
+
+    def _acquire(self):
+        """Take connection from the pool: pair (host, connection). Connection is None, if new one must be opened"""
+        with self.lock:
+            if self.pool.empty() and self.pool_size < self.connections:
+                self.pool_size += 1
+                return None, None
+        return self.pool.get()
+
+    def _connect(self, scheme, netloc):
+        connection_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        return connection_class(netloc, timeout=self.timeout)
+
+    def _wait_rate_limit(self):
+        if not self.min_interval: return
+        with self.lock:
+            now = time.monotonic()
+            request_time = max(now, self.next_request_time)
+            self.next_request_time = request_time + self.min_interval
+        if request_time > now:
+            time.sleep(request_time - now)
+
+    def fetch_url(self, url):
+        """Download data by the URL, using pooled connection. Returns bytes"""
+        scheme, netloc, path, query, _ = urlsplit(url)
+        if query: path = path + "?" + query
+        host = (scheme, netloc)
+        connection_host, connection = self._acquire()
+        if connection is not None and connection_host != host:
+            connection.close()
+            connection = None
+        try:
+            for attempt in range(self.retries+1):
+                if attempt:
+                    time.sleep(self.backoff * 2**(attempt-1) * random.uniform(0.5, 1.5))
+                self._wait_rate_limit()
+                with self.lock:
+                    self.requests += 1
+                    self.retried += attempt > 0
+                instrument.count("requests")
+                instrument.count("retries", attempt > 0)
+                try:
+                    if connection is None:
+                        connection = self._connect(scheme, netloc)
+                    connection.request("GET", path)
+                    response = connection.getresponse()
+                    data = response.read()
+                except (OSError, http.client.HTTPException) as err:
+                    #Connection is broken, reconnect on the next attempt.
+                    if connection is not None:
+                        connection.close()
+                    connection = None
+                    error = MapFetchError("Failed to download {0}: {1}".format(url, err))
+                    continue
+                if response.status == 200:
+                    with self.lock:
+                        self.bytes_downloaded += len(data)
+                    instrument.count("bytes_downloaded", len(data))
+                    return data
+                error = MapFetchError("Failed to download {0}: HTTP {1} {2}".format(url, response.status, response.reason))
+                if response.status != 429 and response.status < 500:
+                    break
+            raise error
+        finally:
+            self.pool.put((host, connection))
+
+    def fetch(self, center, zoom, size, type="satellite", format="png", scale=1):
+        """Download one map image. Returns bytes of the image file"""
+        if not is_supported_map_type(type): raise ValueError("Bad map type: {0}".format(type))
+        with instrument.stage("download"):
+            return self.fetch_url(map_url(center, zoom, size, type, format, scale, self.base_url))
+
+    def submit(self, **request):
+        """Start downloading of the map image in background. Returns Future; keyword arguments are the same as for fetch"""
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.connections)
+        return self.executor.submit(self.fetch, **request)
+
+    def fetch_many(self, requests):
+        """Download several map images concurrently. 
+        requests: list of dictionaries with keyword arguments of the fetch method. Returns list of bytes, in the same order"""
+        futures = [self.submit(**request) for request in requests]
+        return [future.result() for future in futures]
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        while not self.pool.empty():
+            _, connection = self.pool.get()
+            if connection is not None:
+                connection.close()
+        self.pool_size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
 def is_supported_map_type(type):
     return type in __map_types
 
-def get_map(outfile, center, zoom, size, type="satellite", format=None, scale=1):
+def get_map(outfile, center, zoom, size, type="satellite", format=None, scale=1, base_url=None):
     if not is_supported_map_type(type): raise ValueError("Bad map type: {0}".format(type))
     if isinstance(outfile, str):
         ext = splitext(outfile)[1]
         if format is None:
             format = __ext2format[ext.lower()]
         with open(outfile,"wb") as hfile:
-            return get_map(hfile, center, zoom, size, type, format=format)
+            return get_map(hfile, center, zoom, size, type, format=format, scale=scale, base_url=base_url)
 
-    stream = get_map_stream( center, zoom, size, type, format, scale )
+    stream = get_map_stream( center, zoom, size, type, format, scale, base_url )
     try:
         shutil.copyfileobj(stream, outfile)
     finally:
@@ -70,6 +220,9 @@ def main():
                       metavar="MAP_TYPE",
                       help="Type of the map. Can be one of Satellite/Roadmap/Terrain/Composite")
 
+    parser.add_option("", "--base-url", dest="base_url", metavar="URL",
+                      help="URL of the static maps API. Default is Google static maps, or LOGZOOM_MAP_URL environment variable")
+
     (options, args) = parser.parse_args()
     
     if len(args) != 4:
@@ -85,6 +238,6 @@ def main():
     except Exception as e:
         parser.error("Faield to parse argument: %s"%(e))
 
-    get_map( output, (lattitude, longitude), zoom, size, type=options.type.lower() )
+    get_map( output, (lattitude, longitude), zoom, size, type=options.type.lower(), scale=options.scale, base_url=options.base_url )
 
 if __name__=="__main__": main()
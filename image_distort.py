@@ -1,4 +1,11 @@
 from PIL import Image
+from collections import OrderedDict, deque
+from multiprocessing import shared_memory
+import multiprocessing
+import itertools
+import weakref
+import numpy as np
+import instrument
 """Utility functions for simplifying image distortions using functions"""
 
 #Elementary transformations and operations on them
@@ -9,71 +16,648 @@ def compose( *transforms ):
     tc = compose(a,b,c)
 
     assert tc(x,y) == a(*b(*c(x,y)))  for all x,y in domain of tc.
+
+    Nested compositions are flattened, and adjacent affine steps (see affine_tfm) are merged into one.
+    Resulting steps are available in the attribute "steps" of the composition, in the same order as the arguments.
     """
     if not all(map(callable, transforms)):
         raise TypeError("Non-callable object passed as trnasform function")
+    steps = _fold_affine(transforms)
+    if len(steps) == 1:
+        return steps[0]
     def composed(*xy):
-        for t in reversed(transforms):
+        for t in reversed(steps):
             xy = t(*xy)
             if xy is None: return None
         return xy
-    return composed
+
+    array_transforms = [vectorize_tfm(t) for t in reversed(steps)]
+    def composed_array(x, y):
+        #NaN values are propagated through the chain, no need to check them on every step.
+        for t in array_transforms:
+            x, y = t(x, y)
+        return x, y
+    composed.steps = steps
+    params = [getattr(t, "params", None) for t in steps]
+    if None not in params:
+        set_params(composed, "compose", *params)
+    return set_vectorized(composed, composed_array)
+
+def _fold_affine(transforms):
+    """Flatten nested compositions and merge adjacent affine transforms. Returns list of steps"""
+    steps = []
+    for t in transforms:
+        for step in getattr(t, "steps", (t,)):
+            if steps and hasattr(steps[-1], "affine") and hasattr(step, "affine"):
+                a1, b1, c1, d1, e1, f1 = steps[-1].affine
+                a2, b2, c2, d2, e2, f2 = step.affine
+                steps[-1] = affine_tfm(a1*a2 + b1*d2, a1*b2 + b1*e2, a1*c2 + b1*f2 + c1,
+                                       d1*a2 + e1*d2, d1*b2 + e1*e2, d1*c2 + e1*f2 + f1)
+            else:
+                steps.append(step)
+    return steps
+
+def set_affine( tfm, a, b, c, d, e, f ):
+    """Declare, that the transform is affine: (x, y) -> (a*x + b*y + c, d*x + e*y + f). Returns the same function.
+    Adjacent affine transforms are merged by compose.
+    """
+    tfm.affine = (a, b, c, d, e, f)
+    return tfm
+
+def affine_tfm(a, b, c, d, e, f):
+    """Affine transform (x, y) -> (a*x + b*y + c, d*x + e*y + f)"""
+    if b == 0 and d == 0:
+        #Most common case: scale and translate only
+        def tfm(x,y):
+            return a*x + c, e*y + f
+    else:
+        def tfm(x,y):
+            return a*x + b*y + c, d*x + e*y + f
+    #Works for arrays too
+    return set_affine(set_params(set_vectorized(tfm, tfm), "affine", a, b, c, d, e, f), a, b, c, d, e, f)
 
 def scale_tfm(k, ky=None):
     if ky is None: 
         ky = k
     def tfm(x,y):
         return x*k, y*ky
-    return tfm
+    #Works for arrays too
+    return set_affine(set_params(set_vectorized(tfm, tfm), "scale", k, ky), k, 0, 0, 0, ky, 0)
 
 def translate_tfm(dx,dy):
     def tfm(x,y):
         return x+dx, y+dy
-    return tfm
+    return set_affine(set_params(set_vectorized(tfm, tfm), "translate", dx, dy), 1, 0, dx, 0, 1, dy)
 
-def memoize_tfm( tfm, dictionary=None, memo_size=1024 ):
-    """Does not makes a big deal"""
-    queue = deque()
-    dictionary = dict() if (dictionary is None) else dictionary
+def memoize_tfm( tfm, memo_size=1024 ):
+    """Remember last memo_size values of the transform function (least recently used are forgotten).
+    Returned function has attributes "hits" and "misses" with the numbers of cache hits and misses.
+    """
+    memo = OrderedDict()
     def memoized( *xy ):
         try:
-            return dictionary[xy]
+            f = memo[xy]
+            memo.move_to_end(xy)
+            memoized.hits += 1
+            return f
         except KeyError:
-            dictionary[xy] = f = tfm(*xy)
-            queue.append(xy)
-            if len(queue) > memo_size:
-                del dictionary[queue.popleft()]
+            memo[xy] = f = tfm(*xy)
+            memoized.misses += 1
+            if len(memo) > memo_size:
+                memo.popitem(last=False)
             return f
+    memoized.hits = 0
+    memoized.misses = 0
     return memoized
 
+class TransformLattice:
+    """Transform in the array form, evaluated in the integer points and remembered.
+    Values are stored in square blocks of the lattice, keyed by the integer grid position of the block.
+    At most max_blocks blocks are kept, least recently used are forgotten.
+    Calling the lattice is the same as calling the transform, but only integer coordinates are accepted.
+    """
+    def __init__(self, tfm_array, block_size=64, max_blocks=256):
+        self.tfm_array = tfm_array
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.blocks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __call__(self, x, y):
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=np.int64), np.asarray(y, dtype=np.int64))
+        shape = x.shape
+        if x.size == 0:
+            return np.empty(shape), np.empty(shape)
+        #Same point can be requested several times: work with the unique points only
+        x0 = x.min()
+        y0 = y.min()
+        span = x.max() - x0 + 1
+        keys, inverse = np.unique((y.ravel()-y0)*span + (x.ravel()-x0), return_inverse=True)
+        points = np.stack((keys % span + x0, keys // span + y0), axis=1)
+        values = np.empty((len(points), 2))
+        known = np.zeros(len(points), dtype=bool)
 
+        bs = self.block_size
+        block_xy = points // bs
+        local_xy = points - block_xy*bs
+        #Group points by blocks
+        bx0, by0 = block_xy.min(axis=0)
+        bspan = block_xy[:,0].max() - bx0 + 1
+        block_keys, block_index = np.unique((block_xy[:,1]-by0)*bspan + (block_xy[:,0]-bx0), return_inverse=True)
+        order = np.argsort(block_index, kind="stable")
+        groups = np.split(order, np.cumsum(np.bincount(block_index, minlength=len(block_keys)))[:-1])
+        block_keys = zip((block_keys % bspan + bx0).tolist(), (block_keys // bspan + by0).tolist())
+
+        blocks = []
+        for key, group in zip(block_keys, groups):
+            block = self.blocks.get(key)
+            if block is None:
+                block = self.blocks[key] = (np.empty((bs, bs, 2)), np.zeros((bs, bs), dtype=bool))
+            else:
+                self.blocks.move_to_end(key)
+            block_values, block_known = block
+            lx, ly = local_xy[group].T
+            known[group] = block_known[ly, lx]
+            values[group] = block_values[ly, lx]
+            blocks.append((block, group))
+
+        missing = np.flatnonzero(~known)
+        self.hits += x.size - len(missing)
+        self.misses += len(missing)
+        if len(missing):
+            fx, fy = self.tfm_array(*points[missing].T.astype(np.float64))
+            values[missing, 0] = fx
+            values[missing, 1] = fy
+            for (block_values, block_known), group in blocks:
+                lx, ly = local_xy[group].T
+                block_values[ly, lx] = values[group]
+                block_known[ly, lx] = True
+
+        while len(self.blocks) > self.max_blocks:
+            self.blocks.popitem(last=False)
+
+        values = values[inverse]
+        return values[:,0].reshape(shape), values[:,1].reshape(shape)
+
+def set_vectorized( tfm, tfm_array ):
+    """Attach native array form to the transform function. Returns the same function.
+    tfm_array must take arrays x, y and return arrays of transformed coordinates, with NaN where tfm returns None.
+    """
+    tfm.vectorized = tfm_array
+    return tfm
+
+def set_params( tfm, *params ):
+    """Attach description of the transform: its name and numeric parameters, that determine it completely. Returns the same function.
+    Transforms with known parameters can be cached by their description (see plan_cache.PlanCache).
+    Composition of the transforms with known parameters has known parameters too.
+    """
+    tfm.params = params
+    return tfm
+
+def domain_mask( x, y ):
+    """Mask of the points, where transform in the array form is defined"""
+    return np.isfinite(x) & np.isfinite(y)
+
+def vectorize_tfm( tfm ):
+    """Convert transform function to the array form.
+    Array form takes 2 arrays of coordinates (of the same shape) and returns 2 arrays of transformed coordinates.
+    Points, where the function is not defined (returns None), are NaN.
+    If transform has native array implementation (attribute "vectorized"), it is used.
+    """
+    vectorized = getattr(tfm, "vectorized", None)
+    if vectorized is not None:
+        return vectorized
+    def tfm_array(x, y):
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+        xo = np.full(x.shape, np.nan)
+        yo = np.full(x.shape, np.nan)
+        for i in np.flatnonzero(domain_mask(x, y)):
+            xy = tfm(x.flat[i], y.flat[i])
+            if xy is not None:
+                xo.flat[i], yo.flat[i] = xy
+        return xo, yo
+    return tfm_array
 
-def transform_image(source, tfm_func, out_size, mesh_step, add_alpha=False):
+
+def transform_image(source, tfm_func, out_size, mesh_step, add_alpha=False, mesh_tolerance=None, stats=None,
+                    engine="mesh", resample=Image.BICUBIC, jobs=1, plan_cache=None, mipmap=False):
     """Transforms image using given distortion function.
-    The function must fromsform target image coordinates to source image coordinates"""
+    The function must fromsform target image coordinates to source image coordinates
+    mesh_tolerance: if given, adaptive mesh is used, with this maximal interpolation error (in source pixels). mesh_step is then the biggest quad size.
+    stats: optional dictionary, receives number of generated quads and hits/misses of the transform lattice.
+    engine: "mesh" - Image.MESH transform, "remap" - exact source coordinates for every pixel (see remap_image). 
+    resample: Image.NEAREST, Image.BILINEAR or Image.BICUBIC
+    jobs: number of processes. If more than 1, output is split to strips, rendered in parallel (see render_strips).
+    plan_cache: optional PlanCache. Mesh (or coordinate map of the remap engine) is loaded from it, if the transform has known parameters.
+    mipmap: sample minified regions from the prefiltered pyramid of the source (see build_pyramid), to avoid aliasing.
+      Mesh engine selects the nearest pyramid level for every quad, remap engine blends 2 nearest levels for every pixel.
+    """
+    if jobs > 1:
+        out_width, out_height = out_size
+        #Several strips per process, to balance the load
+        strip_height = -(-out_height // (4*jobs))
+        out = None
+        for y0, strip in render_strips(source, tfm_func, out_size, strip_height, mesh_step, jobs=jobs,
+                                       add_alpha=add_alpha, mesh_tolerance=mesh_tolerance, stats=stats,
+                                       engine=engine, resample=resample, plan_cache=plan_cache, mipmap=mipmap):
+            if out is None:
+                out = Image.new(strip.mode, out_size)
+            out.paste(strip, (0, y0))
+        return out
+
+    if engine == "remap":
+        with instrument.stage("remap"):
+            return remap_image(source, tfm_func, out_size, add_alpha=add_alpha, stats=stats, resample=resample,
+                               plan_cache=plan_cache, mipmap=mipmap)
+    elif engine != "mesh":
+        raise ValueError("Unknown transform engine: {0}".format(engine))
+
     out_width, out_height = out_size
-    mesh = make_mesh(tfm_func, out_width, out_height, mesh_step)
-    if add_alpha:
-        mesh = list(mesh)
-    out = source.transform(out_size, Image.MESH, 
-                           mesh, 
-                           Image.BICUBIC )
+    lattice = TransformLattice(vectorize_tfm(tfm_func))
+    def build_mesh():
+        if mesh_tolerance is None:
+            return make_mesh(lattice, out_width, out_height, mesh_step)
+        else:
+            return make_mesh_adaptive(lattice, out_width, out_height, max_error=mesh_tolerance, max_step=mesh_step)
+    with instrument.stage("mesh"):
+        if plan_cache is None:
+            mesh = build_mesh()
+        else:
+            mesh = plan_cache.mesh(tfm_func, out_size, build_mesh, mesh_step=mesh_step, mesh_tolerance=mesh_tolerance)
+    if stats is not None:
+        stats["quads"] = len(mesh)
+        stats["lattice_hits"] = lattice.hits
+        stats["lattice_misses"] = lattice.misses
+    instrument.count("quads", len(mesh))
+    instrument.count("transform_points", lattice.misses)
+    instrument.count("lattice_hits", lattice.hits)
+    instrument.count("lattice_misses", lattice.misses)
+    with instrument.stage("transform"):
+        if mipmap:
+            return _transform_mipmap(source, out_size, mesh, resample, add_alpha)
+        out = source.transform(out_size, Image.MESH, 
+                               mesh, 
+                               resample )
+
+        if add_alpha:
+            alpha = Image.new("L", source.size, 255).transform(
+                out_size, Image.MESH, 
+                mesh,
+                Image.NEAREST )
+            out.putalpha(alpha)
+    return out
+
+def build_pyramid(source):
+    """Mipmap pyramid of the image: list of images, starting from the source, every next is 2 times smaller.
+    Levels are prefiltered by the box filter. Coordinates in the level k are the source coordinates divided by 2**k.
+    """
+    levels = [source]
+    while min(levels[-1].size) >= 2:
+        levels.append(levels[-1].reduce(2))
+    return levels
+
+#Pyramid of the last used source. Strips of the same image share it; worker processes receive it in the shared memory.
+_last_pyramid = (None, None)
+
+def _source_pyramid(source):
+    global _last_pyramid
+    source_ref, pyramid = _last_pyramid
+    if source_ref is None or source_ref() is not source:
+        pyramid = build_pyramid(source)
+        _last_pyramid = (weakref.ref(source), pyramid)
+    return pyramid
+
+def _mesh_levels(mesh, max_level):
+    """Pyramid level for every quad of the mesh: nearest to the scale of the quad (its longest side, relative to the box)"""
+    boxes = np.array([box for box, _ in mesh], dtype=np.float64).reshape(-1, 4)
+    quads = np.array([quad for _, quad in mesh], dtype=np.float64).reshape(-1, 8)
+    #Quad corners: upper left, lower left, lower right, upper right
+    scale_x = np.hypot(quads[:,6]-quads[:,0], quads[:,7]-quads[:,1]) / (boxes[:,2]-boxes[:,0])
+    scale_y = np.hypot(quads[:,2]-quads[:,0], quads[:,3]-quads[:,1]) / (boxes[:,3]-boxes[:,1])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lod = np.log2(np.fmax(scale_x, scale_y))
+    return np.clip(np.nan_to_num(np.floor(lod + 0.5), nan=0.0, neginf=0.0), 0, max_level).astype(int)
 
+def _transform_mipmap(source, out_size, mesh, resample, add_alpha):
+    """Mesh transform, where every quad is sampled from the level of the source pyramid, matching its scale"""
+    pyramid = _source_pyramid(source)
+    levels = _mesh_levels(mesh, len(pyramid)-1)
+    out = coverage = None
+    for level in np.unique(levels).tolist():
+        k = 0.5**level
+        level_mesh = [(mesh[i][0], tuple(c*k for c in mesh[i][1])) for i in np.flatnonzero(levels == level).tolist()]
+        level_image = pyramid[level].transform(out_size, Image.MESH, level_mesh, resample)
+        level_coverage = Image.new("L", pyramid[level].size, 255).transform(out_size, Image.MESH, level_mesh, Image.NEAREST)
+        instrument.count("mipmap_quads_level{0}".format(level), len(level_mesh))
+        if out is None:
+            out, coverage = level_image, level_coverage
+        else:
+            out.paste(level_image, (0, 0), level_coverage)
+            coverage.paste(level_coverage, (0, 0), level_coverage)
+    if out is None:
+        out = source.transform(out_size, Image.MESH, mesh, resample)
+        coverage = Image.new("L", out_size, 0)
     if add_alpha:
-        alpha = Image.new("L", im.size, 255).transform(
-            out_size, Image.MESH, 
-            mesh,
-            Image.NEAREST )
-        out.putalpha(alpha)
+        out.putalpha(coverage)
+    return out
+
+def _render_strip(source, tfm_func, out_size, y0, strip_height, mesh_step, kwargs):
+    """Render one strip of the output, starting at the row y0. Returns (strip, stats)"""
+    out_width, out_height = out_size
+    strip_stats = {}
+    strip = transform_image(source, compose(tfm_func, translate_tfm(0, y0)), 
+                            (out_width, min(strip_height, out_height-y0)), mesh_step, 
+                            stats=strip_stats, **kwargs)
+    return strip, strip_stats
+
+def render_strips(source, tfm_func, out_size, strip_height, mesh_step=8, jobs=1, **kwargs):
+    """Transform image by horizontal strips of the output. Generates pairs (y0, strip_image).
+    Strip height is rounded to the multiple of mesh_step, so that the mesh is the same as for the whole image.
+    With jobs=1, only one strip is in memory at a time. With jobs>1, strips are rendered in a pool of processes, 
+    and up to 2*jobs strips are in memory (see render_strips_parallel).
+    Other arguments are the same as for the transform_image; values in the stats are summed over the strips.
+    """
+    stats = kwargs.pop("stats", None)
+    strip_height = max(1, strip_height // mesh_step) * mesh_step
+    if jobs > 1:
+        strips = render_strips_parallel(source, tfm_func, out_size, strip_height, mesh_step, jobs, kwargs)
+    else:
+        strips = ((y0,) + _render_strip(source, tfm_func, out_size, y0, strip_height, mesh_step, kwargs)
+                  for y0 in range(0, out_size[1], strip_height))
+    for y0, strip, strip_stats in strips:
+        if stats is not None:
+            for key, value in strip_stats.items():
+                stats[key] = stats.get(key, 0) + value
+        yield y0, strip
+
+#Task of the worker processes. It is set before the pool is created, and inherited by the forked processes,
+#because transform functions are closures and can not be pickled.
+_worker_task = None
+_worker_source = None
+
+def _init_strip_worker(shm_name, mode, layout):
+    global _worker_source, _worker_shm, _last_pyramid
+    _worker_shm = shared_memory.SharedMemory(name=shm_name)
+    images = [Image.frombuffer(mode, size, _worker_shm.buf[offset:offset+length], "raw", mode, 0, 1)
+              for offset, length, size in layout]
+    _worker_source = images[0]
+    if len(images) > 1:
+        #Pyramid, built by the parent
+        _last_pyramid = (weakref.ref(_worker_source), images)
+
+def _strip_worker(y0):
+    tfm_func, out_size, strip_height, mesh_step, kwargs = _worker_task
+    strip, strip_stats = _render_strip(_worker_source, tfm_func, out_size, y0, strip_height, mesh_step, kwargs)
+    report = instrument.snapshot()
+    instrument.reset()
+    return y0, strip.mode, strip.size, strip.tobytes(), strip_stats, report
+
+def render_strips_parallel(source, tfm_func, out_size, strip_height, mesh_step, jobs, kwargs):
+    """Render strips in a pool of jobs processes. Generates triples (y0, strip, stats) in order of y0.
+    Source image (and its mipmap pyramid, if kwargs has mipmap) is placed to the shared memory, workers read it without copying.
+    Requires "fork" start method of processes; where it is not available, strips are rendered sequentially.
+    """
+    global _worker_task
+    out_height = out_size[1]
+    try:
+        context = multiprocessing.get_context("fork")
+    except ValueError:
+        for y0 in range(0, out_height, strip_height):
+            yield (y0,) + _render_strip(source, tfm_func, out_size, y0, strip_height, mesh_step, kwargs)
+        return
+
+    #Pyramid is built once here, level 0 is the source itself
+    images = _source_pyramid(source) if kwargs.get("mipmap") else [source]
+    images_data = [image.tobytes() for image in images]
+    shm = shared_memory.SharedMemory(create=True, size=max(1, sum(map(len, images_data))))
+    try:
+        #(offset, length, size) of every image in the shared memory
+        layout = []
+        offset = 0
+        for image, data in zip(images, images_data):
+            shm.buf[offset:offset+len(data)] = data
+            layout.append((offset, len(data), image.size))
+            offset += len(data)
+        del images_data
+        _worker_task = (tfm_func, out_size, strip_height, mesh_step, kwargs)
+        with context.Pool(jobs, initializer=_init_strip_worker, initargs=(shm.name, source.mode, layout)) as pool:
+            _worker_task = None
+            #Keep limited number of strips in flight, so that slow consumer does not make them accumulate in memory.
+            pending = deque()
+            rows = iter(range(0, out_height, strip_height))
+            for y0 in itertools.islice(rows, 2*jobs):
+                pending.append(pool.apply_async(_strip_worker, (y0,)))
+            while pending:
+                y0, mode, size, data, strip_stats, report = pending.popleft().get()
+                instrument.merge(report)
+                for next_y0 in itertools.islice(rows, 1):
+                    pending.append(pool.apply_async(_strip_worker, (next_y0,)))
+                yield y0, Image.frombytes(mode, size, data), strip_stats
+    finally:
+        _worker_task = None
+        shm.close()
+        shm.unlink()
+
+def strip_height_for_memory(source, out_width, memory_limit, mesh_step=8, engine="mesh", mipmap=False, jobs=1):
+    """Height of the output strip, such that rendering it takes approximately memory_limit bytes, together with the source image.
+    With jobs>1, up to 2*jobs strips are in memory at once (see render_strips), and the limit is shared by them.
+    Height is a multiple of mesh_step. Raises ValueError if the limit is too small even for a single row of the mesh per strip.
+    """
+    source_bytes = source.size[0] * source.size[1] * len(source.getbands())
+    if mipmap:
+        #Pyramid levels take 1/3 of the source together
+        source_bytes = source_bytes * 4 // 3
+    if engine == "remap":
+        #coordinate arrays, sampling accumulators and the output
+        row_bytes = out_width * 160
+    else:
+        #output image, plus mesh list: every quad takes approximately 500 bytes of Python objects.
+        #Quads are subdivided near the discontinuities, reserve some space for that
+        row_bytes = out_width * 4 + 2 * (out_width // mesh_step + 1) * 500 // mesh_step
+    strips = 2*jobs if jobs > 1 else 1
+    rows = (memory_limit - source_bytes) // row_bytes // strips
+    if rows < mesh_step:
+        raise ValueError("Memory limit of {0} bytes is too small: source image takes {1} bytes, and {2} strips of {3} rows take {4} bytes".format(
+            memory_limit, source_bytes, strips, mesh_step, strips * mesh_step * row_bytes))
+    return rows // mesh_step * mesh_step
+
+def _cubic_weights(d):
+    """Weights of the 4 neighbour pixels, for the same cubic kernel as used by the Pillow (a=-1)"""
+    d2 = d*d
+    d3 = d2*d
+    return (-d + 2*d2 - d3,
+            1 - 2*d2 + d3,
+            d + d2 - d3,
+            -d2 + d3)
+
+def premultiply_alpha(pixels):
+    """RGBA pixels (HxWx4 uint8 array) with colors multiplied by alpha, rounded the same way, as Pillow converts RGBA to RGBa"""
+    out = pixels.copy()
+    tmp = pixels[...,:3].astype(np.uint32) * pixels[...,3:] + 128
+    out[...,:3] = ((tmp >> 8) + tmp) >> 8
+    return out
+
+def unpremultiply_alpha(pixels):
+    """Inverse of premultiply_alpha, truncating the same way, as Pillow converts RGBa to RGBA. Works for any shape ...x4"""
+    out = pixels.copy()
+    alpha = pixels[...,3:].astype(np.uint32)
+    partial = (alpha > 0) & (alpha < 255)
+    colors = np.minimum(pixels[...,:3].astype(np.uint32) * 255 // np.maximum(alpha, 1), 255)
+    out[...,:3] = np.where(partial, colors, pixels[...,:3])
     return out
 
+def sample_pixels(pixels, u, v, resample=Image.BICUBIC, premultiplied=False):
+    """Sample image pixels in the given points.
+    pixels: array HxWxC. u, v: 1-d arrays of source coordinates, pixel (i,j) occupies square [i,i+1)x[j,j+1).
+    Points outside of the image or NaN give zero values, the same as Image.transform.
+    RGBA pixels (C=4) are interpolated with colors premultiplied by alpha, as Image.transform does,
+    so that colors of the transparent pixels don't bleed. premultiplied: pixels are already premultiplied (see premultiply_alpha),
+    use it to avoid converting the same source again for every call.
+    Returns array NxC of the same type, as pixels.
+    """
+    if pixels.shape[2] != 4 or (resample == Image.NEAREST and not premultiplied):
+        return _sample_channels(pixels, u, v, resample)
+    if not premultiplied:
+        pixels = premultiply_alpha(pixels)
+    return unpremultiply_alpha(_sample_channels(pixels, u, v, resample))
+
+def _sample_channels(pixels, u, v, resample):
+    """Sample every channel independently, see sample_pixels"""
+    h, w, channels = pixels.shape
+    flat = pixels.reshape(h*w, channels)
+    out = np.zeros((len(u), channels), dtype=pixels.dtype)
+    with np.errstate(invalid="ignore"):
+        inside = (u >= 0) & (u < w) & (v >= 0) & (v < h)
+    u = u[inside]
+    v = v[inside]
+    if resample == Image.NEAREST:
+        out[inside] = flat[ v.astype(np.intp)*w + u.astype(np.intp) ]
+        return out
+
+    #Pixel centers are at the half-integer points
+    u = u - 0.5
+    v = v - 0.5
+    x = np.floor(u)
+    y = np.floor(v)
+    dx = (u - x).astype(np.float32)
+    dy = (v - y).astype(np.float32)
+    x = x.astype(np.intp)
+    y = y.astype(np.intp)
+    if resample == Image.BILINEAR:
+        offsets = (0, 1)
+        wx = (1-dx, dx)
+        wy = (1-dy, dy)
+    elif resample == Image.BICUBIC:
+        offsets = (-1, 0, 1, 2)
+        wx = _cubic_weights(dx)
+        wy = _cubic_weights(dy)
+    else:
+        raise ValueError("Unsupported resampling filter: {0}".format(resample))
+    #Pixels outside of the image are replaced by the nearest edge pixels
+    columns = [np.clip(x+i, 0, w-1) for i in offsets]
+    acc = np.zeros((len(u), channels), dtype=np.float32)
+    for j, wyj in zip(offsets, wy):
+        row_start = np.clip(y+j, 0, h-1)*w
+        row = np.zeros_like(acc)
+        for column, wxi in zip(columns, wx):
+            row += flat[row_start + column] * wxi[:,None]
+        acc += row * wyj[:,None]
+    out[inside] = np.clip(np.rint(acc), 0, 255)
+    return out
+
+def _mip_lod(u, v, max_level):
+    """Level of detail (fractional pyramid level) for every pixel of the coordinate maps u, v (2-d arrays).
+    Scale is the longest of the derivatives by x and y, estimated by finite differences.
+    Of the forward and backward differences, the shortest is used, so that discontinuities of the map don't blur the image.
+    """
+    def derivative_length(axis):
+        lengths = [np.hypot(np.diff(u, axis=axis, **{side: np.nan}), np.diff(v, axis=axis, **{side: np.nan}))
+                   for side in ("prepend", "append")]
+        return np.fmin(*lengths)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lod = np.log2(np.fmax(derivative_length(1), derivative_length(0)))
+    return np.clip(np.nan_to_num(lod, nan=0.0, neginf=0.0), 0, max_level)
+
+def sample_mipmap(levels, u, v, lod, resample=Image.BICUBIC, premultiplied=False):
+    """Sample pyramid of pixel arrays (see sample_pixels) with the trilinear filtering: 
+    every point is sampled from the 2 levels, nearest to its level of detail lod, and the samples are blended.
+    RGBA levels are sampled and blended with premultiplied alpha; premultiplied: levels are already premultiplied.
+    """
+    rgba = levels[0].shape[2] == 4
+    if rgba and not premultiplied:
+        levels = [premultiply_alpha(pixels) for pixels in levels]
+    lod = lod.astype(np.float32)
+    base = np.floor(lod).astype(int)
+    t = lod - base
+    acc = np.zeros((len(u), levels[0].shape[2]), dtype=np.float32)
+    for level, pixels in enumerate(levels):
+        lower = base == level
+        upper = (base == level-1) & (t > 0)
+        selected = lower | upper
+        if not selected.any(): continue
+        k = 0.5**level
+        weights = np.where(lower[selected], 1-t[selected], t[selected])
+        acc[selected] += _sample_channels(pixels, u[selected]*k, v[selected]*k, resample) * weights[:,None]
+    out = np.clip(np.rint(acc), 0, 255).astype(levels[0].dtype)
+    return unpremultiply_alpha(out) if rgba else out
+
+def remap_image(source, tfm_func, out_size, resample=Image.BICUBIC, add_alpha=False, stats=None, chunk_pixels=1<<20, plan_cache=None,
+                mipmap=False):
+    """Transforms image, calculating exact source coordinates for every output pixel.
+    Unlike Image.MESH transform, there is no interpolation of the distortion function, and no mesh.
+    Image is processed by chunks of rows of about chunk_pixels pixels, to limit memory use.
+    Supported image modes are L, RGB and RGBA.
+    plan_cache: optional PlanCache, storing source coordinates of the output pixels by chunks.
+    mipmap: sample from the pyramid of the source, with the trilinear filtering (see sample_mipmap).
+    """
+    if source.mode not in ("L", "RGB", "RGBA"):
+        raise ValueError("Unsupported image mode: {0}".format(source.mode))
+    out_width, out_height = out_size
+    tfm_array = vectorize_tfm(tfm_func)
+    pixels = np.asarray(source).reshape(source.size[1], source.size[0], -1)
+    if mipmap:
+        levels = [np.asarray(level).reshape(level.size[1], level.size[0], -1) for level in _source_pyramid(source)]
+    #RGBA is interpolated with premultiplied alpha; convert the source once, not for every chunk
+    premultiplied = source.mode == "RGBA" and (mipmap or resample != Image.NEAREST)
+    if premultiplied:
+        pixels = premultiply_alpha(pixels)
+        if mipmap:
+            levels = [premultiply_alpha(level) for level in levels]
+    out = np.empty((out_height, out_width, pixels.shape[2]), dtype=np.uint8)
+    if add_alpha:
+        alpha = np.empty((out_height, out_width), dtype=np.uint8)
+
+    chunk_rows = max(1, chunk_pixels // max(1, out_width))
+    #Image.transform samples the distortion in the pixel centers
+    xs = np.arange(out_width) + 0.5
+    def chunk_coordinates(y0, y1):
+        x, y = np.meshgrid(xs, np.arange(y0, y1) + 0.5)
+        instrument.count("transform_points", x.size)
+        return tfm_array(x.ravel(), y.ravel())
+
+    if plan_cache is not None:
+        compute_coordinates = chunk_coordinates
+        def chunk_coordinates(y0, y1):
+            #Coordinates are cached by chunks, so that the map of the whole output is never in memory
+            def build_coordinates():
+                u, v = compute_coordinates(y0, y1)
+                return np.stack([u, v], axis=-1).reshape(y1-y0, out_width, 2)
+            coordinates = plan_cache.coordinates(tfm_func, out_size, build_coordinates, rows=(y0, y1))
+            return coordinates[:,:,0].ravel(), coordinates[:,:,1].ravel()
+
+    for y0 in range(0, out_height, chunk_rows):
+        y1 = min(out_height, y0+chunk_rows)
+        u, v = chunk_coordinates(y0, y1)
+        if mipmap:
+            lod = _mip_lod(u.reshape(y1-y0, out_width), v.reshape(y1-y0, out_width), len(levels)-1).ravel()
+            out[y0:y1] = sample_mipmap(levels, u, v, lod, resample, premultiplied).reshape(y1-y0, out_width, -1)
+        else:
+            out[y0:y1] = sample_pixels(pixels, u, v, resample, premultiplied).reshape(y1-y0, out_width, -1)
+        if add_alpha:
+            with np.errstate(invalid="ignore"):
+                alpha[y0:y1] = np.where((u >= 0) & (u < source.size[0]) & (v >= 0) & (v < source.size[1]),
+                                        255, 0).reshape(y1-y0, out_width)
+    if stats is not None:
+        stats["pixels"] = out_width*out_height
+
+    out_image = Image.fromarray(out[:,:,0] if source.mode == "L" else out, source.mode)
+    if add_alpha:
+        out_image.putalpha(Image.fromarray(alpha, "L"))
+    return out_image
+
 def make_mesh_simple(tfm_func, out_width, out_height, mesh_step):
     """Generates mesh data, accepted by the Image.transform, for the given geometry transformation function"""
+    #Corners are shared with the left and the upper neighbours: remember enough values for 2 rows of the grid.
+    tfm_func = memoize_tfm(tfm_func, memo_size=2*(out_width//mesh_step+2))
     for yd in range(0,out_height,mesh_step):
         for xd in range(0,out_width, mesh_step):
-            #suboptimal... but fast enough for me. Possible optimization: remember map function values.
             box = (xd,yd,xd+mesh_step,yd+mesh_step)
-            quad = eval_box_corners(box)
+            quad = eval_box_corners(box, tfm_func)
             yield( (box,quad) )
 
 
@@ -90,6 +674,9 @@ def make_mesh_for_domain(tfm_func, out_width, out_height, mesh_step,
     """Create mesh for a function, defined on a domain.
     Function is expected to return None if there is no value
     """
+    #Corners are shared with the neighbours, and subdivisions reuse corners of the parent box.
+    tfm_func = memoize_tfm(tfm_func, memo_size=4*(out_width//mesh_step+2)+1024)
+
     def continuous(a,b,c,d):
         xx = a[0],b[0],c[0],d[0]
         yy = a[1],b[1],c[1],d[1]
@@ -138,68 +725,259 @@ def make_mesh_for_domain(tfm_func, out_width, out_height, mesh_step,
     #Top-level grid
     for yd in range(0,out_height,mesh_step):
         for xd in range(0,out_width, mesh_step):
-            #suboptimal... but fast enough for me. Possible optimization: remember map function values.
             yield from subdivisions((xd,yd,xd+mesh_step,yd+mesh_step))
-    
-"""
-def make_mesh_adaptive(tfm_func, out_width, out_height, min_absolute_distortion=None):
-    if min_absolute_distortion is None:
-        min_absolute_distortion = max(1, min( 5, (out_width+out_height)*0.05 ))
-    min_absolute_distortion2 = .1 #min_absolute_distortion ** 2
-
-    def subdivide_quad(box, quad):
-        x1,y1,x2,y2 = box
-        if min(x2-x1, y2-y1) <= 1: 
-            yield ( (box, quad) )
-        else:
-            w = x2-x1
-            h = y2-y1
-            w2 = w // 2
-            h2 = h // 2
-            #New point is not exactly at the center - get the proportion.
-            px = w2 / w #around 0.5
-            py = h2 / h
-            qx = 1-px
-            qy = 1-py
-            assert( px > 0.4 and px < 0.6 )
-
-            #_Approximate_ center of the box
-            box_center = (x1+w2, y1+h2) 
-
-            #Calculate linear approximation to quad center
-            xa,ya,xb,yb,xc,yc,xd,yd = quad
-            # ad
-            # bc
-            qc_x_linapprox = (xa*qx + xd*px)*qy + (xb*qx + xc*px)*py;
-            qc_y_linapprox = (ya*qx + yd*px)*qy + (yb*qx + yc*px)*py;
-            
-            #And now compare it with the value, the function returns
-            qc_x, qc_y = f_center = tfm_func( *box_center )
-            
-            #Get the distance
-            dist2 = (qc_x - qc_x_linapprox)**2 + (qc_y - qc_y_linapprox)**2
-            sz2 = (xa-xc)**2 + (ya-yc)**2 + (xd-xb)**2 + (yd-yb)**2
-            
-            if dist2 < sz2 * 0.00001:
-                #No need to subdivide
-                #print ("#### no subdiv, yield: ", box, quad )
-                yield ( (x1,y1,x2-1,y2-1), quad)
-            else:
-                #Subdivision required
-                xx = (x1, x1+w2, x2)
-                yy = (y1, y1+h2, y2)
-                #TODO: 5 of 9 are already calculated!
-                ff = [[tfm_func(xi,yi) for xi in xx] for yi in yy]
-                for i in (0,1):
-                    for j in (0,1):
-                        box = (xx[i], yy[j], xx[i+1], yy[j+1])
-                        quad = ff[j][i] + ff[j+1][j] + ff[j+1][i+1] + ff[j][i+1]
-                        #print ("#### sub-box", box, "sub-quad", quad)
-                        yield from subdivide_quad( box, quad )
-    
-    box = (0,0,out_width, out_height)
-    quad = eval_box_corners(box, tfm_func)
-    yield from subdivide_quad( box, quad )
-
-"""
-make_mesh = make_mesh_for_domain
+
+def eval_boxes_corners(boxes, tfm_array):
+    """Vectorized version of the eval_box_corners: array of N boxes -> array of N quads (Nx8).
+    Corners where function is not defined are NaN.
+    """
+    x1, y1, x2, y2 = boxes.T
+    xx = np.concatenate((x1, x1, x2, x2))
+    yy = np.concatenate((y1, y2, y2, y1))
+    return _corners_to_quads( *tfm_array(xx, yy) )
+
+def _corners_to_quads(xx, yy):
+    """Arrays of corner values ordered as [a..., b..., c..., d...] -> Nx8 array of quads"""
+    n = len(xx) // 4
+    return np.stack((xx.reshape(4,n), yy.reshape(4,n)), axis=2).transpose(1,0,2).reshape(n,8)
+
+def _classify_quads(boxes, quads, treat_disconts, discontinuous_limit):
+    """Decide, what to do with every box of the mesh.
+    Returns 3 boolean arrays: (emit quad as is, emit degenerate quad, subdivide)
+    Rules are the same, as in make_mesh_for_domain.
+    """
+    xx = quads[:,0::2]
+    yy = quads[:,1::2]
+    defined = domain_mask(xx, yy)
+    all_defined = defined.all(axis=1)
+    any_defined = defined.any(axis=1)
+    is_big = ((boxes[:,2]-boxes[:,0]) > 1) | ((boxes[:,3]-boxes[:,1]) > 1)
+    if treat_disconts:
+        with np.errstate(invalid="ignore"):
+            continuous = (np.ptp(xx, axis=1) < discontinuous_limit) & (np.ptp(yy, axis=1) < discontinuous_limit)
+        emit = all_defined & continuous
+        emit_degenerate = all_defined & ~continuous & ~is_big
+    else:
+        emit = all_defined
+        emit_degenerate = np.zeros_like(emit)
+    subdivide = any_defined & ~emit & ~emit_degenerate & is_big
+    return emit, emit_degenerate, subdivide
+
+def _subdivide_boxes(boxes):
+    """Split every box into 4 parts, the same way as make_mesh_for_domain does. Empty parts are removed"""
+    x1, y1, x2, y2 = boxes.T
+    xm = x1 + (x2-x1)//2
+    ym = y1 + (y2-y1)//2
+    sub = np.concatenate((np.stack((x1, y1, xm, ym), axis=1),
+                          np.stack((xm, y1, x2, ym), axis=1),
+                          np.stack((x1, ym, xm, y2), axis=1),
+                          np.stack((xm, ym, x2, y2), axis=1)))
+    return sub[ (sub[:,2] > sub[:,0]) & (sub[:,3] > sub[:,1]) ]
+
+def _mesh_to_list(boxes, quads):
+    """Convert arrays of boxes and quads to the list, accepted by Image.transform"""
+    return [ (tuple(box), tuple(quad)) for box, quad in zip(boxes.tolist(), quads.tolist()) ]
+
+def _top_level_grid(lattice, out_width, y0, y1, mesh_step):
+    """Boxes of the regular grid, covering the rows y0...y1 of the output image, and their quads."""
+    #Evaluate function in the lattice nodes, and then take quad corners from it.
+    nx = -(-out_width // mesh_step)
+    xs = np.arange(nx+1) * mesh_step
+    ys = np.arange(y0, y1+mesh_step, mesh_step)
+    fx, fy = lattice(*np.meshgrid(xs, ys))
+    values = np.stack((fx, fy), axis=2)
+    # A D
+    # B C
+    quads = np.concatenate((values[:-1,:-1], values[1:,:-1], values[1:,1:], values[:-1,1:]),
+                           axis=2).reshape(-1, 8)
+    x1, y1 = np.meshgrid(xs[:-1], ys[:-1])
+    x1 = x1.ravel()
+    y1 = y1.ravel()
+    boxes = np.stack((x1, y1, x1+mesh_step, y1+mesh_step), axis=1)
+
+    return boxes, quads
+
+def _bilinear_quad_error(boxes, quads, lattice):
+    """Maximal distance between the transform and its bilinear interpolation inside the quad.
+    Checked in the center of the box and in the middles of its sides, i.e. in the points, that would become new corners after subdivision.
+    """
+    x1, y1, x2, y2 = boxes.T
+    xm = x1 + (x2-x1)//2
+    ym = y1 + (y2-y1)//2
+    #         center, top, bottom, left, right
+    px = np.stack((xm, xm, xm, x1, x2))
+    py = np.stack((ym, y1, y2, ym, ym))
+    fx, fy = lattice(px, py)
+    #New point is not exactly at the center - get the proportion.
+    tx = (px - x1) / (x2 - x1)
+    ty = (py - y1) / (y2 - y1)
+    # A D
+    # B C
+    xa,ya,xb,yb,xc,yc,xd,yd = quads.T
+    lx = (xa*(1-tx) + xd*tx)*(1-ty) + (xb*(1-tx) + xc*tx)*ty
+    ly = (ya*(1-tx) + yd*tx)*(1-ty) + (yb*(1-tx) + yc*tx)*ty
+    with np.errstate(invalid="ignore"):
+        err = np.hypot(fx-lx, fy-ly).max(axis=0)
+    #If function is not defined in the check points, box must be subdivided to find the domain boundary
+    return np.where(np.isnan(err), np.inf, err)
+
+def _mesh_arrays(lattice, out_width, out_height, mesh_step, treat_disconts, discontinuous_limit, max_error=None):
+    """Generates (boxes, quads) arrays of the mesh. 
+    Image is processed by horizontal bands, approximately one lattice block high, to keep the cached values local.
+    If max_error is given, good quads are subdivided until they are accurate enough.
+    """
+    band_step = mesh_step * max(1, lattice.block_size // mesh_step)
+    for band_y in range(0, out_height, band_step):
+        boxes, quads = _top_level_grid(lattice, out_width, band_y, min(band_y+band_step, out_height), mesh_step)
+        while len(boxes):
+            emit, emit_degenerate, subdivide = _classify_quads(boxes, quads, treat_disconts, discontinuous_limit)
+            if max_error is not None:
+                #Good quads that are not small enough are subdivided too.
+                is_big = ((boxes[:,2]-boxes[:,0]) > 1) | ((boxes[:,3]-boxes[:,1]) > 1)
+                check = np.flatnonzero(emit & is_big)
+                if len(check):
+                    inaccurate = check[ _bilinear_quad_error(boxes[check], quads[check], lattice) > max_error ]
+                    emit[inaccurate] = False
+                    subdivide[inaccurate] = True
+            yield boxes[emit], quads[emit]
+            if emit_degenerate.any():
+                yield boxes[emit_degenerate], np.tile(quads[emit_degenerate,0:2], 4)
+            instrument.count("quads_subdivided", int(np.count_nonzero(subdivide)))
+            boxes = _subdivide_boxes(boxes[subdivide])
+            quads = eval_boxes_corners(boxes, lattice)
+
+def _collect_mesh(parts):
+    """Join (boxes, quads) pairs of arrays into the list, accepted by Image.transform"""
+    parts = list(parts)
+    if not parts: return []
+    boxes, quads = zip(*parts)
+    return _mesh_to_list(np.concatenate(boxes), np.concatenate(quads))
+
+def _as_lattice(tfm_array):
+    return tfm_array if isinstance(tfm_array, TransformLattice) else TransformLattice(tfm_array)
+
+def make_mesh_vectorized(tfm_array, out_width, out_height, mesh_step,
+                         treat_disconts=True, discontinuous_limit=100):
+    """Vectorized version of the make_mesh_for_domain.
+    tfm_array is a transform in the array form (see vectorize_tfm): it returns NaN where it is not defined.
+    It is evaluated through the TransformLattice, so that the corners, shared by the neighbouring quads, are evaluated once.
+    Returns list of (box, quad) pairs, ready to be passed to the Image.transform. 
+    Mesh is the same, as produced by make_mesh_for_domain, except for the order of the quads.
+    """
+    return _collect_mesh(_mesh_arrays(_as_lattice(tfm_array), out_width, out_height, mesh_step,
+                                      treat_disconts, discontinuous_limit))
+
+def make_mesh_adaptive(tfm_array, out_width, out_height, max_error=0.5, max_step=64,
+                       treat_disconts=True, discontinuous_limit=100):
+    """Create mesh with quads of variable size.
+    Starts from the grid with step max_step and subdivides only the quads, where bilinear interpolation of the transform
+    differs from the true value by more than max_error pixels of the source image.
+    Undefined regions and discontinuities are handled the same way, as in make_mesh_for_domain.
+    tfm_array is a transform in the array form (see vectorize_tfm).
+    """
+    return _collect_mesh(_mesh_arrays(_as_lattice(tfm_array), out_width, out_height, max_step,
+                                      treat_disconts, discontinuous_limit, max_error=max_error))
+
+make_mesh = make_mesh_vectorized
+
+_resample_filters = {"nearest": Image.NEAREST,
+                     "bilinear": Image.BILINEAR,
+                     "bicubic": Image.BICUBIC}
+
+def add_render_options(parser, mesh_step=8, streaming=True):
+    """Add options, controlling the transform, to the OptionParser. Use render_options to get them from the parsed options"""
+    parser.add_option("", "--mesh-step", dest="mesh_step", type=int, default=mesh_step, metavar="PIXELS",
+                      help="Step of the output mesh. Default is {0}. With --mesh-tolerance, this is the biggest quad size".format(mesh_step))
+    parser.add_option("", "--mesh-tolerance", dest="mesh_tolerance", type=float, metavar="PIXELS",
+                      help="Use adaptive mesh, with the given maximal interpolation error, in source image pixels.")
+    parser.add_option("", "--engine", dest="engine", default="mesh", choices=["mesh", "remap"],
+                      help="Transform engine: mesh (interpolated distortion, default) or remap (exact coordinates of every pixel)")
+    parser.add_option("", "--filter", dest="filter", default="bicubic", choices=sorted(_resample_filters),
+                      help="Resampling filter: nearest, bilinear or bicubic (default)")
+    parser.add_option("-j", "--jobs", dest="jobs", type=int, default=1, metavar="N",
+                      help="Number of processes for rendering. Default is 1")
+    parser.add_option("", "--mipmap", dest="mipmap", action="store_true", default=False,
+                      help="Sample minified regions from the prefiltered pyramid of the source image, to avoid aliasing")
+    parser.add_option("", "--stats", dest="stats", metavar="FILE.json",
+                      help="Write time of the processing stages, counters and peak memory use to the JSON file")
+    parser.add_option("", "--plan-cache", dest="plan_cache", metavar="FOLDER",
+                      help="Folder to store computed meshes and coordinate maps. Renders with the same geometry load them instead of recomputing.")
+    if streaming:
+        parser.add_option("", "--memory-limit", dest="memory_limit", type=float, metavar="MB",
+                          help="Render output by horizontal strips, keeping memory use approximately within the limit. Output must be PNG file.")
+
+def render_options(options):
+    """Keyword arguments for the transform_image, from the options, added by add_render_options"""
+    plan_cache = None
+    if options.plan_cache:
+        from plan_cache import PlanCache
+        plan_cache = PlanCache(options.plan_cache)
+    return {"mesh_step": options.mesh_step,
+            "mesh_tolerance": options.mesh_tolerance,
+            "engine": options.engine,
+            "resample": _resample_filters[options.filter],
+            "jobs": options.jobs,
+            "plan_cache": plan_cache,
+            "mipmap": options.mipmap}
+
+def render_summary(stats):
+    """Short text description of the stats, filled by transform_image"""
+    if "quads" in stats:
+        lookups = stats["lattice_hits"] + stats["lattice_misses"]
+        return "Mesh: {0} quads, transform lattice hit rate {1:.0%}".format(
+            stats["quads"], stats["lattice_hits"] / lookups if lookups else 0)
+    else:
+        return "Remapped {pixels} pixels".format(**stats)
+
+def check_render_options(options, source, out_size, output):
+    """Check the options, added by add_render_options, for rendering source to the output of the given size, before rendering.
+    Raises ValueError, describing the wrong option.
+    """
+    if options.mesh_step < 1:
+        raise ValueError("Mesh step must be positive")
+    if options.jobs < 1:
+        raise ValueError("Number of jobs must be positive")
+    if options.engine == "remap" and source.mode not in ("L", "RGB", "RGBA"):
+        raise ValueError("Remap engine does not support image mode {0}".format(source.mode))
+    if getattr(options, "memory_limit", None):
+        if output is None or not output.lower().endswith(".png"):
+            raise ValueError("Memory limit requires PNG output file")
+        strip_height_for_memory(source, out_size[0], int(options.memory_limit*2**20),
+                                options.mesh_step, options.engine, options.mipmap, options.jobs)
+
+def render_to_output(source, tfm_func, out_size, output, options):
+    """Transform image according to the options, added by add_render_options, and save it to output (or show, if output is None).
+    Prints short summary of the transform.
+    """
+    render_stats = {}
+    if getattr(options, "memory_limit", None):
+        from png_stream import PNGStripWriter
+        if output is None or not output.lower().endswith(".png"):
+            raise ValueError("Memory limit requires PNG output file")
+        kwargs = render_options(options)
+        strip_height = strip_height_for_memory(source, out_size[0], int(options.memory_limit*2**20),
+                                               kwargs["mesh_step"], kwargs["engine"], kwargs["mipmap"], kwargs["jobs"])
+        print("Rendering by strips of {0} rows".format(strip_height))
+        with PNGStripWriter(output, out_size, source.mode) as writer:
+            for y0, strip in render_strips(source, tfm_func, out_size, strip_height, stats=render_stats, **kwargs):
+                with instrument.stage("encode"):
+                    writer.write_strip(y0, strip)
+        print(render_summary(render_stats))
+        if kwargs["plan_cache"] is not None:
+            print(kwargs["plan_cache"].summary())
+        if options.stats:
+            instrument.save(options.stats)
+        return
+
+    kwargs = render_options(options)
+    img = transform_image(source, tfm_func, out_size, stats=render_stats, **kwargs)
+    print(render_summary(render_stats))
+    if kwargs["plan_cache"] is not None:
+        print(kwargs["plan_cache"].summary())
+    if output:
+        with instrument.stage("encode"):
+            img.save(output)
+    else:
+        img.show()
+    if options.stats:
+        instrument.save(options.stats)
@@ -0,0 +1,132 @@
+"""Instrumentation of the processing: wall-clock time of the stages and counters of the events.
+
+Library code reports to the module-level collector:
+    with instrument.stage("mesh"):
+        ...
+    instrument.count("quads", len(mesh))
+Host process can read the collected values (snapshot, save), or subscribe to the events:
+    instrument.subscribe(lambda kind, name, value: print(kind, name, value))
+kind is "stage" (value is the duration in seconds) or "count" (value is the increment).
+Stages may run concurrently in several threads; their times are summed.
+Forked child process starts with no values and no subscribers.
+"""
+from contextlib import contextmanager
+import threading
+import time
+import json
+import sys
+import os
+try:
+    import resource
+except ImportError:
+    #No peak memory information on this platform
+    resource = None
+
+_lock = threading.Lock()
+_stages = {}
+_counters = {}
+_subscribers = []
+_start_time = time.monotonic()
+
+def reset(forget_subscribers=False):
+    """Forget all collected values, and optionally the subscribers"""
+    global _start_time
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+        if forget_subscribers:
+            del _subscribers[:]
+        _start_time = time.monotonic()
+
+def _after_fork_in_child():
+    #Lock may be held by another thread of the parent at the moment of fork, so it is replaced, not acquired
+    global _lock, _start_time
+    _lock = threading.Lock()
+    _stages.clear()
+    _counters.clear()
+    del _subscribers[:]
+    _start_time = time.monotonic()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+def subscribe(callback):
+    """Call callback(kind, name, value) on every event. Callback is called in the thread, where event happened"""
+    with _lock:
+        _subscribers.append(callback)
+
+def unsubscribe(callback):
+    with _lock:
+        _subscribers.remove(callback)
+
+def _notify(kind, name, value):
+    for callback in list(_subscribers):
+        callback(kind, name, value)
+
+def count(name, n=1):
+    """Increase counter"""
+    if not n: return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+    if _subscribers:
+        _notify("count", name, n)
+
+@contextmanager
+def stage(name):
+    """Context, measuring time of the stage"""
+    t0 = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - t0
+        with _lock:
+            seconds, calls = _stages.get(name, (0.0, 0))
+            _stages[name] = (seconds + elapsed, calls + 1)
+        if _subscribers:
+            _notify("stage", name, elapsed)
+
+def merge(report):
+    """Add values from the snapshot, taken in another process"""
+    for name, values in report["stages"].items():
+        with _lock:
+            seconds, calls = _stages.get(name, (0.0, 0))
+            _stages[name] = (seconds + values["seconds"], calls + values["calls"])
+        if _subscribers:
+            _notify("stage", name, values["seconds"])
+    for name, n in report["counters"].items():
+        count(name, n)
+
+def difference(report, base):
+    """Values, collected between the two snapshots"""
+    stages = {}
+    for name, values in report["stages"].items():
+        base_values = base["stages"].get(name, {"seconds": 0.0, "calls": 0})
+        if values["calls"] != base_values["calls"]:
+            stages[name] = {"seconds": values["seconds"] - base_values["seconds"],
+                            "calls": values["calls"] - base_values["calls"]}
+    counters = {name: n - base["counters"].get(name, 0) for name, n in report["counters"].items()
+                if n != base["counters"].get(name, 0)}
+    return {"wall_seconds": report["wall_seconds"] - base["wall_seconds"],
+            "stages": stages,
+            "counters": counters,
+            "peak_memory_bytes": report["peak_memory_bytes"]}
+
+def peak_memory():
+    """Peak resident memory of the process in bytes, or None if unknown"""
+    if resource is None: return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #Linux reports kilobytes, macOS - bytes
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+def snapshot():
+    """Collected values, as a JSON-compatible dictionary"""
+    with _lock:
+        return {"wall_seconds": time.monotonic() - _start_time,
+                "stages": {name: {"seconds": seconds, "calls": calls} for name, (seconds, calls) in _stages.items()},
+                "counters": dict(_counters),
+                "peak_memory_bytes": peak_memory()}
+
+def save(path):
+    """Write snapshot to the JSON file"""
+    with open(path, "w") as stats_file:
+        json.dump(snapshot(), stats_file, indent=2, sort_keys=True)
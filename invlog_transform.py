@@ -2,7 +2,8 @@
 from PIL import Image
 from math import *
 import os
-from image_distort import transform_image, compose, scale_tfm, translate_tfm
+import numpy as np
+from image_distort import compose, scale_tfm, translate_tfm, set_vectorized, set_params, add_render_options, check_render_options, render_to_output
 
 def inv_logpolar_transform(image_size, y0, out_width, out_height, alpha0 = 0):
     """Inverse log polar transform
@@ -28,7 +29,15 @@ def inv_logpolar_transform(image_size, y0, out_width, out_height, alpha0 = 0):
         else:
             return atan2(yf, xf), log(xf*xf+yf*yf)*0.5
 
-        
+    def logz_array(xf,yf):
+        r2 = xf*xf+yf*yf
+        at_zero = r2 == 0
+        with np.errstate(divide="ignore"):
+            return (np.where(at_zero, 0.0, np.arctan2(yf, xf)),
+                    np.where(at_zero, 1e-2, np.log(r2)*0.5))
+
+    set_params(set_vectorized(logz, logz_array), "logz")
+
     tfm_func1 = compose(
         #without translate, min y is: -log_rmax*source_scale. It must be y0.
         translate_tfm( source_scale*pi, log_rmax*source_scale+y0 ),
@@ -53,8 +62,7 @@ def main():
     parser.add_option("-H", "--height", dest="height", type=int, default=1024,
                       help="Height of the output image", metavar="PIXELS")
 
-    parser.add_option("", "--mesh-step", dest="mesh_step", type=int, default=8,
-                      help="Step of the output mesh. Default is 8", metavar="PIXELS")
+    add_render_options(parser)
 
     (options, args) = parser.parse_args()
     
@@ -89,12 +97,11 @@ def main():
                                        options.width,
                                        options.height)
 
-    img = transform_image(img, transform, out_size, mesh_step=options.mesh_step)
-
-    if output:
-        img.save(output)
-    else:
-        img.show()
+    try:
+        check_render_options(options, img, out_size, output)
+    except ValueError as err:
+        parser.error(str(err))
+    render_to_output(img, transform, out_size, output, options)
     
 
 if __name__=="__main__":
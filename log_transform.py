@@ -2,7 +2,8 @@
 from PIL import Image
 from math import *
 import os
-from image_distort import transform_image, compose, scale_tfm, translate_tfm
+import numpy as np
+from image_distort import compose, scale_tfm, translate_tfm, set_vectorized, set_params, add_render_options, check_render_options, render_to_output
 
 def logpolar_transform(image_size, center, out_width=None, out_height=None, alpha0 = 0):
     swidth, sheight = image_size
@@ -46,7 +47,13 @@ def logpolar_transform(image_size, center, out_width=None, out_height=None, alph
         xfs = cos(xf)*ey
         return xfs + x0, yfs + y0
 
-    return (out_width, out_height), tfm_func
+    def tfm_array(x,y):
+        xf = x*out_scale + alpha0
+        ey = np.exp(max_log-y*out_scale)
+        return np.cos(xf)*ey + x0, np.sin(xf)*ey + y0
+
+    set_params(tfm_func, "logpolar", x0, y0, out_scale, alpha0, max_log)
+    return (out_width, out_height), set_vectorized(tfm_func, tfm_array)
 
 def main():
     from optparse import OptionParser
@@ -65,8 +72,7 @@ def main():
     parser.add_option("-H", "--height", dest="height", type=int,
                       help="Height of the output image. Default is auto-detect, based on width", metavar="PIXELS")
 
-    parser.add_option("", "--mesh-step", dest="mesh_step", type=int, default=8,
-                      help="Step of the output mesh. Default is 8", metavar="PIXELS")
+    add_render_options(parser)
 
     parser.add_option("", "--mercator2ortho", dest="mercator2ortho",
                       help="Treat source image as a piece of the map in Mercator projection. Map in converted to orthogonal projection regarding the point in the center of the map.", metavar="CENTER_LAT:LNG_WIDTH")
@@ -142,12 +148,11 @@ def main():
                                                  out_width = options.width,
                                                  alpha0 = options.angle/180*pi)
 
-    img = transform_image(img, transform, out_size, mesh_step=options.mesh_step)
-
-    if output:
-        img.save(output)
-    else:
-        img.show()
+    try:
+        check_render_options(options, img, out_size, output)
+    except ValueError as err:
+        parser.error(str(err))
+    render_to_output(img, transform, out_size, output, options)
     
 
 if __name__=="__main__":
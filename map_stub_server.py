@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+"""Local stand-in for the static maps API, for testing and benchmarking without network.
+Serves deterministic synthetic images in Web Mercator projection, for the same query format as gmap_get uses:
+   /maps/api/staticmap?center=LAT,LON&zoom=Z&size=WxH&scale=S&maptype=TYPE&format=png
+Latency, error rate and bandwidth of the server are configurable.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from PIL import Image
+from io import BytesIO
+from math import *
+import numpy as np
+import threading
+import random
+import time
+
+__palettes = {"satellite": ((40, 70, 30), (90, 120, 60), (200, 190, 150)),
+              "roadmap":   ((235, 230, 220), (250, 250, 245), (230, 150, 60)),
+              "hybrid":    ((40, 70, 30), (90, 120, 60), (250, 220, 80)),
+              "terrain":   ((200, 220, 180), (230, 230, 200), (150, 120, 90))}
+
+def render_map(center, zoom, size, scale=1, maptype="roadmap"):
+    """Synthetic map image. Pattern depends only on the world coordinates of the pixels,
+    so images of the same place at different zooms are consistent, like real maps.
+    Pattern is a checkerboard of 16x16-pixel world cells at every zoom level, plus graticule lines every 10 degrees.
+    """
+    lat, lon = center
+    width, height = size
+    world_size = 256 * 2**zoom
+    #World coordinates of the center, in pixels of the zoom level
+    cx = (lon / 360 + 0.5) * world_size
+    cy = (0.5 - asinh(tan(radians(lat))) / (2*pi)) * world_size
+    x = cx + (np.arange(width*scale) + 0.5 - width*scale*0.5) / scale
+    y = cy + (np.arange(height*scale) + 0.5 - height*scale*0.5) / scale
+    x, y = np.meshgrid(x, y)
+    #Checkerboard cells of all scales, visible at this zoom: blend 3 levels, for the smooth appearance at any zoom
+    shade = np.zeros(x.shape)
+    for level in range(3):
+        cell = 16 * 2**level
+        shade += ((np.floor(x / cell) + np.floor(y / cell)) % 2) / 2**level
+    shade /= 1.75
+    #Graticule
+    lon_deg = (x / world_size - 0.5) * 360
+    lat_deg = np.degrees(np.arctan(np.sinh((0.5 - y / world_size) * 2*pi)))
+    line_width = 360.0 / world_size * 1.5
+    lines = (np.abs((lon_deg + 5) % 10 - 5) < line_width) | (np.abs((lat_deg + 5) % 10 - 5) < line_width)
+
+    dark, light, line = (np.array(c, dtype=np.float64) for c in __palettes.get(maptype, __palettes["roadmap"]))
+    pixels = dark + (light - dark) * shade[:,:,None]
+    pixels[lines] = line
+    return Image.fromarray(pixels.astype(np.uint8), "RGB")
+
+class StubMapServer(ThreadingHTTPServer):
+    """HTTP server, emulating static maps API.
+    latency: delay before the response, seconds (uniformly distributed in [0, 2*latency]).
+    error_rate: fraction of requests, answered with HTTP 503.
+    bandwidth: maximal transfer rate of one response, bytes per second (None - unlimited).
+    seed: seed of the random generator for latencies and errors.
+    Attributes requests and errors count served requests.
+    """
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0), latency=0.0, error_rate=0.0, bandwidth=None, seed=0):
+        super().__init__(address, StubMapHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.bandwidth = bandwidth
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.thread = None
+
+    @property
+    def url(self):
+        """Base URL of the API, to be used with gmap_get"""
+        host, port = self.server_address[:2]
+        return "http://{0}:{1}/maps/api/staticmap".format(host, port)
+
+    def start(self):
+        """Start serving in a background thread"""
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+class StubMapHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            delay = server.random.uniform(0, 2*server.latency)
+            fail = server.random.random() < server.error_rate
+            if fail: server.errors += 1
+        if delay: time.sleep(delay)
+
+        url = urlsplit(self.path)
+        if url.path != "/maps/api/staticmap":
+            return self.send_data(404, b"Not found", "text/plain")
+        if fail:
+            return self.send_data(503, b"Service unavailable", "text/plain")
+        try:
+            query = parse_qs(url.query)
+            lat, lon = map(float, query["center"][0].split(","))
+            zoom = int(query["zoom"][0])
+            width, height = map(int, query["size"][0].split("x"))
+            scale = int(query.get("scale", ["1"])[0])
+            maptype = query.get("maptype", ["roadmap"])[0]
+            image_format = query.get("format", ["png"])[0].lower()
+            if image_format not in ("png", "jpg", "gif"): raise ValueError("Bad format: " + image_format)
+        except (KeyError, ValueError) as err:
+            return self.send_data(400, "Bad request: {0}".format(err).encode("utf-8"), "text/plain")
+
+        #Real API truncates too big images
+        width = min(width, 640)
+        height = min(height, 640)
+        image = render_map((lat, lon), zoom, (width, height), scale, maptype)
+        buffer = BytesIO()
+        image.save(buffer, {"jpg": "JPEG"}.get(image_format, image_format.upper()))
+        self.send_data(200, buffer.getvalue(), "image/" + {"jpg": "jpeg"}.get(image_format, image_format))
+
+    def send_data(self, status, data, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        bandwidth = self.server.bandwidth
+        if not bandwidth:
+            self.wfile.write(data)
+            return
+        #Send by chunks of 1/20 second
+        chunk = max(1, int(bandwidth / 20))
+        for i in range(0, len(data), chunk):
+            self.wfile.write(data[i:i+chunk])
+            self.wfile.flush()
+            time.sleep(len(data[i:i+chunk]) / bandwidth)
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage = "%prog [options]\n"
+                          "Run local stand-in for the static maps API, serving synthetic images.\n"
+                          "Use it with: LOGZOOM_MAP_URL=http://HOST:PORT/maps/api/staticmap ./auto_glue.py ...")
+    parser.add_option("-p", "--port", dest="port", type=int, default=8765,
+                      help="Port to listen. Default is 8765")
+    parser.add_option("", "--host", dest="host", default="127.0.0.1",
+                      help="Address to listen. Default is 127.0.0.1")
+    parser.add_option("", "--latency", dest="latency", type=float, default=0.0, metavar="SECONDS",
+                      help="Average response delay")
+    parser.add_option("", "--error-rate", dest="error_rate", type=float, default=0.0, metavar="FRACTION",
+                      help="Fraction of requests, failed with HTTP 503")
+    parser.add_option("", "--bandwidth", dest="bandwidth", type=float, metavar="KB_PER_SECOND",
+                      help="Transfer rate of every response. Default is unlimited")
+    parser.add_option("", "--seed", dest="seed", type=int, default=0,
+                      help="Random seed for latencies and errors")
+    (options, args) = parser.parse_args()
+    if args: parser.error("Unexpected arguments")
+
+    server = StubMapServer((options.host, options.port), latency=options.latency, error_rate=options.error_rate,
+                           bandwidth=options.bandwidth and options.bandwidth*1024, seed=options.seed)
+    print ("Serving maps at {0}".format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__=="__main__": main()
@@ -2,7 +2,8 @@
 from PIL import Image
 from math import *
 import os
-from image_distort import transform_image, compose, scale_tfm, translate_tfm
+import numpy as np
+from image_distort import compose, scale_tfm, translate_tfm, set_vectorized, set_params, add_render_options, check_render_options, render_to_output
 
 def orthogonal_projection_width(mercator_image_size, latitude,  angular_width):
     """Determine withd (in earth radiuses) of the orthogonal projection of the given piece of the mercator map.
@@ -71,6 +72,20 @@ def mercator2ortho(mercator_image_size, latitude,  angular_width, out_width):
         return (atan2( y, x ),             #lambda2 
                 asinh( z/r_xy ) - y_merc0) #asinh(tan(phi2))
 
+    def ortho2merc_array( xp, yp ):
+        r2 = xp**2 + yp**2
+        with np.errstate(invalid="ignore", divide="ignore"):
+            zp = np.sqrt(1 - r2)
+            x, z = zp * cos_phi0 - yp * sin_phi0, \
+                   zp * sin_phi0 + yp * cos_phi0
+            y = xp
+            r_xy = np.sqrt(x**2 + y**2)
+            undefined = (r2 > 1) | (r_xy == 0)
+            return (np.where(undefined, np.nan, np.arctan2( y, x )),
+                    np.where(undefined, np.nan, np.arcsinh( z/r_xy ) - y_merc0))
+
+    set_params(set_vectorized(ortho2merc_tfm, ortho2merc_array), "ortho2merc", phi0)
+
     #angular size of 1 pixel
     src_pixel_size = angular_width / swidth
 
@@ -99,6 +114,7 @@ def main():
 
     parser.add_option("-w", "--width", dest="width", type=int,
                       help="Width of the output image. Default is same as input wdth in pixels", metavar="PIXELS")
+    add_render_options(parser, mesh_step=16)
 
     (options, args) = parser.parse_args()
     
@@ -123,11 +139,11 @@ def main():
                                             options.width or img.size[0], 
                                         )
 
-    img = transform_image(img, transform, out_size, mesh_step=16)
-    if output:
-        img.save(output)
-    else:
-        img.show()
+    try:
+        check_render_options(options, img, out_size, output)
+    except ValueError as err:
+        parser.error(str(err))
+    render_to_output(img, transform, out_size, output, options)
     
 
 if __name__=="__main__":
@@ -0,0 +1,142 @@
+"""Persistent cache of the transform plans: meshes and coordinate maps, that depend only on the transform parameters"""
+from collections import OrderedDict
+import numpy as np
+import instrument
+import threading
+import tempfile
+import hashlib
+import json
+import os
+
+#Increase when format of the stored plans changes
+plan_format_version = 1
+
+def _canonical(value):
+    """Convert transform parameters to the JSON-compatible value with unique representation"""
+    if isinstance(value, (tuple, list)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, (bool, str)) or value is None:
+        return value
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    #Exact representation of the floats
+    return float(value).hex()
+
+def tfm_params(tfm):
+    """Parameters of the transform function (see image_distort.set_params), or None if they are unknown"""
+    return getattr(tfm, "params", None)
+
+class PlanCache:
+    """Cache of the transform plans in a folder.
+
+    Plan is either a mesh for the Image.MESH transform (stored as Nx12 array: box and quad of every mesh element),
+    or a map of the exact source coordinates for every pixel of a band of output rows (HxWx2 array), used by the remap engine.
+    Plans are stored as .npy files, named by the hash of the transform parameters and render settings,
+    and coordinate maps are memory-mapped when loaded. Recently used plans are also kept in memory,
+    at most memory_items of them, taking at most memory_bytes in total.
+    Only transforms with known parameters (attribute "params") can be cached.
+    If folder is None, plans are kept only in memory.
+    """
+    def __init__(self, folder, memory_items=16, memory_bytes=256*2**20):
+        self.folder = folder
+        self.memory_items = memory_items
+        self.memory_bytes = memory_bytes
+        self.memory = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if folder is not None:
+            os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def key(kind, tfm, out_size, **settings):
+        """Hash of the plan, or None if transform parameters are unknown"""
+        params = tfm_params(tfm)
+        if params is None: return None
+        description = [plan_format_version, kind, params, out_size, sorted(settings.items())]
+        return hashlib.sha1(json.dumps(_canonical(description)).encode("ascii")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.folder, key + ".npy")
+
+    def _get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                instrument.count("plan_cache_hits")
+                return self.memory[key]
+        plan = None
+        if self.folder is not None:
+            try:
+                plan = np.load(self._path(key), mmap_mode="r")
+            except (IOError, ValueError):
+                pass
+        with self.lock:
+            if plan is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._remember(key, plan)
+        instrument.count("plan_cache_misses" if plan is None else "plan_cache_hits")
+        return plan
+
+    def _remember(self, key, plan):
+        old = self.memory.pop(key, None)
+        if old is not None:
+            self.bytes -= old.nbytes
+        self.memory[key] = plan
+        self.bytes += plan.nbytes
+        while self.memory and (len(self.memory) > self.memory_items or self.bytes > self.memory_bytes):
+            _, old = self.memory.popitem(last=False)
+            self.bytes -= old.nbytes
+
+    def _put(self, key, plan):
+        if self.folder is None:
+            with self.lock:
+                self._remember(key, plan)
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, prefix=".tmp-", suffix=".npy")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                np.save(tmp_file, plan)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        with self.lock:
+            self._remember(key, plan)
+
+    def mesh(self, tfm, out_size, build, **settings):
+        """Mesh of the transform, loaded from the cache or created by build() and stored.
+        settings are the mesh parameters (step, tolerance...), that become a part of the key.
+        Returns list of (box, quad) pairs, as accepted by Image.transform.
+        """
+        from image_distort import _mesh_to_list
+        key = self.key("mesh", tfm, out_size, **settings)
+        plan = None if key is None else self._get(key)
+        if plan is None:
+            mesh = build()
+            if key is not None:
+                self._put(key, np.array([box + quad for box, quad in mesh], dtype=np.float64).reshape(-1, 12))
+            return mesh
+        return _mesh_to_list(plan[:,:4].astype(np.int64), plan[:,4:])
+
+    def coordinates(self, tfm, out_size, build, rows, **settings):
+        """Map of the source coordinates of the output rows (y0, y1) of the transform, loaded from the cache or created by build() and stored.
+        Maps are cached by bands of rows, so that the whole map of a big image is never in memory.
+        Returns (y1-y0)xWx2 array (memory-mapped, if loaded from the disk).
+        """
+        key = self.key("coordinates", tfm, out_size, rows=rows, **settings)
+        plan = None if key is None else self._get(key)
+        if plan is None:
+            plan = build()
+            if key is not None:
+                self._put(key, plan)
+        return plan
+
+    def summary(self):
+        requests = self.hits + self.misses
+        return "Plan cache: {0} hits, {1} misses ({2:.0%} hit rate)".format(
+            self.hits, self.misses, self.hits / requests if requests else 0)
@@ -0,0 +1,76 @@
+"""Writing PNG images by horizontal strips, without keeping the whole image in memory"""
+import zlib
+import struct
+import numpy as np
+
+_color_types = {"L": 0, "RGB": 2, "RGBA": 6}
+
+def _chunk(ctype, data):
+    return struct.pack(">I", len(data)) + ctype + data + struct.pack(">I", zlib.crc32(ctype + data) & 0xffffffff)
+
+class PNGStripWriter:
+    """Writes 8-bit PNG file, receiving image rows by strips, from top to bottom.
+    Usage:
+       with PNGStripWriter("out.png", (width, height), "RGBA") as writer:
+           for y0, strip in strips:
+               writer.write_strip(y0, strip)
+    """
+    def __init__(self, path_or_file, size, mode="RGBA", compress_level=6):
+        if mode not in _color_types:
+            raise ValueError("Unsupported image mode: {0}".format(mode))
+        self.size = size
+        self.mode = mode
+        self.rows_written = 0
+        if isinstance(path_or_file, str):
+            self.file = open(path_or_file, "wb")
+            self.own_file = True
+        else:
+            self.file = path_or_file
+            self.own_file = False
+        self.compressor = zlib.compressobj(compress_level)
+        width, height = size
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        self.file.write(_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, _color_types[mode], 0, 0, 0)))
+
+    def write_strip(self, y0, strip):
+        """Write next rows of the image. Strip is a PIL image or HxWxC array; y0 must be the next row to write"""
+        if y0 != self.rows_written:
+            raise ValueError("Strips must be written sequentially: expected row {0}, got {1}".format(self.rows_written, y0))
+        if hasattr(strip, "mode"):
+            if strip.mode != self.mode:
+                strip = strip.convert(self.mode)
+            strip = np.asarray(strip)
+        rows = strip.reshape(strip.shape[0], -1)
+        if rows.shape[1] != self.size[0] * len(self.mode):
+            raise ValueError("Strip width does not match image width")
+        if self.rows_written + rows.shape[0] > self.size[1]:
+            raise ValueError("Too many rows written")
+        #"Sub" filter: every byte is stored as difference with the same byte of the previous pixel
+        bpp = len(self.mode)
+        filtered = np.empty((rows.shape[0], rows.shape[1]+1), dtype=np.uint8)
+        filtered[:,0] = 1
+        filtered[:,1:bpp+1] = rows[:,:bpp]
+        filtered[:,bpp+1:] = rows[:,bpp:] - rows[:,:-bpp]
+        data = self.compressor.compress(filtered.tobytes())
+        if data:
+            self.file.write(_chunk(b"IDAT", data))
+        self.rows_written += rows.shape[0]
+
+    def close(self):
+        if self.compressor is None: return
+        if self.rows_written != self.size[1]:
+            raise ValueError("Image is incomplete: {0} rows of {1} written".format(self.rows_written, self.size[1]))
+        self.file.write(_chunk(b"IDAT", self.compressor.flush()))
+        self.file.write(_chunk(b"IEND", b""))
+        self.compressor = None
+        if self.own_file:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.own_file:
+            self.file.close()
@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+"""Long-running render service. Accepts render jobs as JSON over HTTP (on a localhost port or a Unix socket),
+and runs them by a bounded pool of threads, keeping plan, mask, source image and fragment caches warm between the jobs.
+
+Requests:
+   POST /jobs        - submit job (JSON object, see below). Returns job record, with HTTP 202.
+                       With "wait": true in the job, responds when the job is finished.
+                       HTTP 503, if the queue is full; HTTP 400, if the job is malformed.
+   GET /jobs/ID      - job record: status (queued, running, done, failed), times, error.
+   GET /status       - queue depth, number of jobs by status, queue and run latencies, cache summaries, instrumentation.
+
+Jobs (all have "kind" and "output", and optional render settings: mesh_step, mesh_tolerance, engine, filter, mipmap):
+   {"kind": "logpolar", "input": PATH, "center": [X, Y], "angle": DEGREES, "width": W, "height": H}
+   {"kind": "invlog", "input": PATH, "top": Y, "width": W, "height": H}
+   {"kind": "mercator2ortho", "input": PATH, "center_lat": DEGREES, "lng_width": DEGREES, "width": W}
+   {"kind": "glue", "lat": LAT, "lon": LON, "zooms": "Z0:Z1", "map_type": TYPE, "width": W, "fragment_size": PIXELS,
+    "alpha_gradient_size": PIXELS, "alpha_profile": PROFILE, "tile_size": PIXELS, "tile_format": FORMAT}
+Example:
+   curl --unix-socket /tmp/logzoom.sock -d '{"kind": "invlog", "input": "map.png", "output": "frame.png", "wait": true}' http://localhost/jobs
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingUnixStreamServer
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from image_distort import transform_image, _resample_filters
+from fragment_cache import FragmentCache, MemoryFragmentCache
+from plan_cache import PlanCache
+from gmap_get import MapClient, is_supported_map_type
+from PIL import Image
+from math import *
+import auto_glue
+import instrument
+import threading
+import itertools
+import json
+import time
+import os
+
+class QueueFull(Exception):
+    pass
+
+def _render_kwargs(job, mesh_step=8):
+    """Keyword arguments of transform_image from the render settings of the job"""
+    engine = job.get("engine", "mesh")
+    if engine not in ("mesh", "remap"):
+        raise ValueError("Unknown engine: {0}".format(engine))
+    resample = job.get("filter", "bicubic")
+    if resample not in _resample_filters:
+        raise ValueError("Unknown filter: {0}".format(resample))
+    mesh_tolerance = job.get("mesh_tolerance")
+    return {"mesh_step": int(job.get("mesh_step", mesh_step)),
+            "mesh_tolerance": None if mesh_tolerance is None else float(mesh_tolerance),
+            "engine": engine,
+            "resample": _resample_filters[resample],
+            "mipmap": bool(job.get("mipmap", False))}
+
+def _zoom_range(zooms):
+    if isinstance(zooms, str):
+        return auto_glue.parse_zoom_range(zooms)
+    z0, z1 = zooms
+    return int(z0), int(z1)
+
+def parse_job(job):
+    """Check the job and convert it to the (kind, arguments) pair. Raises ValueError for bad jobs"""
+    if not isinstance(job, dict):
+        raise ValueError("Job must be JSON object")
+    try:
+        kind = job["kind"]
+        output = job["output"]
+        if kind == "glue":
+            map_type = job.get("map_type", "satellite").lower()
+            if not is_supported_map_type(map_type):
+                raise ValueError("Bad map type: {0}".format(map_type))
+            fragment_size = int(job.get("fragment_size", 512))
+            kwargs = {"map_type": map_type,
+                      "out_width": int(job.get("width", 2048)),
+                      "fragment_size": (fragment_size, fragment_size),
+                      "alpha_gradient_size": int(job.get("alpha_gradient_size", 10)),
+                      "alpha_profile": job.get("alpha_profile", "linear"),
+                      "tile_size": int(job.get("tile_size", 256)),
+                      "tile_format": job.get("tile_format", "png")}
+            if kwargs["alpha_profile"] not in auto_glue.alpha_profiles:
+                raise ValueError("Unknown alpha profile: {0}".format(kwargs["alpha_profile"]))
+            kwargs.update(_render_kwargs(job))
+            return kind, {"coordinates": (float(job["lat"]), float(job["lon"])),
+                          "zoom_range": _zoom_range(job.get("zooms", "0:19")),
+                          "output": output,
+                          "kwargs": kwargs}
+        if kind == "logpolar":
+            center = job.get("center")
+            args = {"center": None if center is None else tuple(map(float, center)),
+                    "angle": radians(float(job.get("angle", 0))),
+                    "width": job.get("width") and int(job["width"]),
+                    "height": job.get("height") and int(job["height"])}
+        elif kind == "invlog":
+            args = {"top": float(job.get("top", 0)),
+                    "width": int(job.get("width", 1024)),
+                    "height": int(job.get("height", 1024))}
+        elif kind == "mercator2ortho":
+            args = {"center_lat": radians(float(job["center_lat"])),
+                    "lng_width": radians(float(job["lng_width"])),
+                    "width": job.get("width") and int(job["width"])}
+        else:
+            raise ValueError("Unknown job kind: {0}".format(kind))
+        args.update(input=job["input"], output=output,
+                    kwargs=_render_kwargs(job, mesh_step=16 if kind == "mercator2ortho" else 8))
+        return kind, args
+    except KeyError as err:
+        raise ValueError("Missing job field: {0}".format(err))
+    except (TypeError, ValueError) as err:
+        raise ValueError("Bad job: {0}".format(err))
+
+class RenderService:
+    """Runs render jobs by a pool of workers threads, with at most max_queue jobs waiting.
+    Caches, shared by the jobs:
+      plan_cache - meshes and coordinate maps (PlanCache, in memory unless it has a folder);
+      source images - recently used input images, decoded (up to source_items);
+      fragment cache - map fragments (auto_glue.fragment_cache, in memory unless set before);
+      feather masks - memoized by auto_glue.make_alpha.
+    Finished job records are kept for the last history_size jobs.
+    verbose: print progress messages of the jobs (they are mixed, if several jobs run at once).
+    """
+    def __init__(self, workers=2, max_queue=16, plan_cache=None, client=None, source_items=4, history_size=1000, verbose=False):
+        self.workers = workers
+        self.verbose = verbose
+        self.max_queue = max_queue
+        self.plan_cache = plan_cache if plan_cache is not None else PlanCache(None, memory_items=64)
+        self.own_client = client is None
+        self.client = client if client is not None else MapClient()
+        if auto_glue.fragment_cache is None:
+            auto_glue.fragment_cache = MemoryFragmentCache()
+        self.source_items = source_items
+        self.sources = OrderedDict()
+        self.history_size = history_size
+        self.jobs = OrderedDict()
+        self.counts = {"queued": 0, "running": 0, "done": 0, "failed": 0, "rejected": 0}
+        #Latencies of the recent jobs: (queue seconds, run seconds)
+        self.latencies = deque(maxlen=1000)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.executor = ThreadPoolExecutor(workers)
+        self.started = time.monotonic()
+
+    def submit(self, job):
+        """Queue the job. Returns (record, future). Raises ValueError for bad jobs, QueueFull if the queue is full"""
+        kind, args = parse_job(job)
+        with self.lock:
+            if self.counts["queued"] >= self.max_queue:
+                self.counts["rejected"] += 1
+                raise QueueFull("Queue is full: {0} jobs waiting".format(self.counts["queued"]))
+            record = {"id": str(next(self.ids)), "kind": kind, "output": args["output"], "status": "queued",
+                      "submitted": time.time()}
+            self.jobs[record["id"]] = record
+            self.counts["queued"] += 1
+            self._forget_old()
+        instrument.count("jobs_submitted")
+        future = self.executor.submit(self._run, record, kind, args, time.monotonic())
+        return record, future
+
+    def _forget_old(self):
+        while len(self.jobs) > self.history_size:
+            old_id = next(iter(self.jobs))
+            if self.jobs[old_id]["status"] in ("queued", "running"): break
+            del self.jobs[old_id]
+
+    def _run(self, record, kind, args, submitted):
+        started = time.monotonic()
+        with self.lock:
+            self.counts["queued"] -= 1
+            self.counts["running"] += 1
+            record["status"] = "running"
+            record["queue_seconds"] = started - submitted
+        try:
+            getattr(self, "_run_" + kind)(**args)
+            status = "done"
+        except Exception as err:
+            status = "failed"
+            record["error"] = "{0}: {1}".format(type(err).__name__, err)
+        finished = time.monotonic()
+        with self.lock:
+            self.counts["running"] -= 1
+            self.counts[status] += 1
+            record["status"] = status
+            record["run_seconds"] = finished - started
+            self.latencies.append((record["queue_seconds"], record["run_seconds"]))
+        return record
+
+    def source_image(self, path):
+        """Input image, converted to RGBA. Recently used images are kept decoded, until their file changes"""
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime, stat.st_size)
+        with self.lock:
+            img = self.sources.get(key)
+            if img is not None:
+                self.sources.move_to_end(key)
+                instrument.count("source_cache_hits")
+                return img
+        instrument.count("source_cache_misses")
+        with instrument.stage("decode"):
+            img = Image.open(path)
+            if img.mode != "RGBA":
+                img = img.convert("RGBA")
+            img.load()
+        with self.lock:
+            self.sources[key] = img
+            while len(self.sources) > self.source_items:
+                self.sources.popitem(last=False)
+        return img
+
+    def _save(self, img, output):
+        with instrument.stage("encode"):
+            img.save(output)
+
+    def _run_logpolar(self, input, output, center, angle, width, height, kwargs):
+        from log_transform import logpolar_transform
+        img = self.source_image(input)
+        out_size, tfm = logpolar_transform(img.size, center, out_width=width, out_height=height, alpha0=angle)
+        self._save(transform_image(img, tfm, out_size, plan_cache=self.plan_cache, **kwargs), output)
+
+    def _run_invlog(self, input, output, top, width, height, kwargs):
+        from invlog_transform import inv_logpolar_transform
+        img = self.source_image(input)
+        tfm = inv_logpolar_transform(img.size, top, width, height)
+        self._save(transform_image(img, tfm, (width, height), plan_cache=self.plan_cache, **kwargs), output)
+
+    def _run_mercator2ortho(self, input, output, center_lat, lng_width, width, kwargs):
+        from mercator2ortho import mercator2ortho
+        img = self.source_image(input)
+        out_size, tfm, _ = mercator2ortho(img.size, center_lat, lng_width, width or img.size[0])
+        self._save(transform_image(img, tfm, out_size, plan_cache=self.plan_cache, **kwargs), output)
+
+    def _run_glue(self, coordinates, zoom_range, output, kwargs):
+        kwargs = dict(kwargs)
+        tile_size = kwargs.pop("tile_size")
+        tile_format = kwargs.pop("tile_format")
+        auto_glue.glue_to_file(coordinates, zoom_range, output, tile_size, tile_format,
+                               client=self.client, plan_cache=self.plan_cache, verbose=self.verbose, **kwargs)
+
+    def job(self, job_id):
+        """Copy of the job record, or None"""
+        with self.lock:
+            record = self.jobs.get(job_id)
+            return dict(record) if record is not None else None
+
+    def status(self):
+        with self.lock:
+            counts = dict(self.counts)
+            latencies = list(self.latencies)
+        def summary(values):
+            if not values: return None
+            values = sorted(values)
+            return {"mean": sum(values) / len(values),
+                    "p50": values[len(values)//2],
+                    "p95": values[min(len(values)-1, int(len(values)*0.95))],
+                    "max": values[-1]}
+        caches = {"plan": self.plan_cache.summary()}
+        if auto_glue.fragment_cache is not None:
+            caches["fragments"] = auto_glue.fragment_cache.summary()
+        return {"uptime_seconds": time.monotonic() - self.started,
+                "workers": self.workers,
+                "queue_depth": counts["queued"],
+                "max_queue": self.max_queue,
+                "jobs": counts,
+                "latency": {"queue_seconds": summary([q for q, _ in latencies]),
+                            "run_seconds": summary([r for _, r in latencies])},
+                "caches": caches,
+                "stats": instrument.snapshot()}
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.own_client:
+            self.client.close()
+
+class RenderHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == "/status":
+            return self.send_json(200, service.status())
+        if self.path.startswith("/jobs/"):
+            record = service.job(self.path[len("/jobs/"):])
+            if record is None:
+                return self.send_json(404, {"error": "Unknown job"})
+            return self.send_json(200, record)
+        self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if self.path != "/jobs":
+            return self.send_json(404, {"error": "Not found"})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            job = json.loads(self.rfile.read(length).decode("utf-8"))
+            record, future = self.server.service.submit(job)
+        except QueueFull as err:
+            return self.send_json(503, {"error": str(err)})
+        except ValueError as err:
+            return self.send_json(400, {"error": str(err)})
+        if job.get("wait"):
+            future.result()
+            return self.send_json(200, self.server.service.job(record["id"]))
+        self.send_json(202, dict(record))
+
+    def send_json(self, status, value):
+        data = (json.dumps(value, indent=2, sort_keys=True) + "\n").encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        #Clients of the Unix socket have no address
+        return str(self.client_address[0]) if self.client_address else "local"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+class RenderServer(ThreadingHTTPServer):
+    """HTTP server of the RenderService on the TCP address"""
+    daemon_threads = True
+
+    def __init__(self, address, service, verbose=False):
+        super().__init__(address, RenderHandler)
+        self.service = service
+        self.verbose = verbose
+
+class UnixRenderServer(ThreadingUnixStreamServer):
+    """HTTP server of the RenderService on the Unix socket"""
+    daemon_threads = True
+
+    def __init__(self, path, service, verbose=False):
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, RenderHandler)
+        self.service = service
+        self.verbose = verbose
+
+def main():
+    from optparse import OptionParser
+    import sys
+    parser = OptionParser(usage = "%prog [options]\n"
+                          "Run render service, accepting jobs as JSON by HTTP, with warm caches.\n"
+                          "See the module documentation for the requests and the job format.")
+    parser.add_option("-p", "--port", dest="port", type=int, default=8766,
+                      help="Port to listen. Default is 8766")
+    parser.add_option("", "--host", dest="host", default="127.0.0.1",
+                      help="Address to listen. Default is 127.0.0.1")
+    parser.add_option("-s", "--socket", dest="socket", metavar="PATH",
+                      help="Listen on the Unix socket instead of the TCP port")
+    parser.add_option("", "--workers", dest="workers", type=int, default=2, metavar="N",
+                      help="Number of jobs, running concurrently. Default is 2")
+    parser.add_option("", "--max-queue", dest="max_queue", type=int, default=16, metavar="N",
+                      help="Maximal number of waiting jobs; more are rejected with HTTP 503. Default is 16")
+    parser.add_option("", "--plan-cache", dest="plan_cache", metavar="FOLDER",
+                      help="Folder to store computed meshes and coordinate maps. By default, they are kept only in memory")
+    parser.add_option("", "--plan-memory", dest="plan_memory", type=float, default=256, metavar="MB",
+                      help="Maximal size of the meshes and coordinate maps, kept in memory. Default is 256")
+    parser.add_option("", "--cache-folder", dest="cache_folder", metavar="FOLDER",
+                      help="Folder to store downloaded map fragments. By default, they are kept only in memory")
+    parser.add_option("", "--cache-size", dest="cache_size", type=float, default=256, metavar="MB",
+                      help="Maximal size of the fragment cache. Default is 256")
+    parser.add_option("", "--cache-raw", dest="cache_raw", action="store_true", default=False,
+                      help="Store decoded fragments in the cache too, to skip decoding on cache hits.")
+    parser.add_option("", "--connections", dest="connections", type=int, default=4, metavar="N",
+                      help="Number of concurrent connections for downloading. Default is 4.")
+    parser.add_option("", "--retries", dest="retries", type=int, default=3, metavar="N",
+                      help="Number of retries of the failed downloads. Default is 3.")
+    parser.add_option("", "--base-url", dest="base_url", metavar="URL",
+                      help="URL of the static maps API. Default is Google static maps, or LOGZOOM_MAP_URL environment variable")
+    parser.add_option("-v", "--verbose", dest="verbose", action="store_true", default=False,
+                      help="Log requests and progress of the jobs")
+    (options, args) = parser.parse_args()
+    if args: parser.error("Unexpected arguments")
+    if options.retries < 0: parser.error("Number of retries must not be negative")
+
+    cache_bytes = int(options.cache_size*2**20)
+    if options.cache_folder:
+        auto_glue.fragment_cache = FragmentCache(options.cache_folder, max_bytes=cache_bytes, raw=options.cache_raw)
+    else:
+        auto_glue.fragment_cache = MemoryFragmentCache(max_bytes=cache_bytes, raw=options.cache_raw)
+    client = MapClient(connections=options.connections, retries=options.retries, base_url=options.base_url)
+    service = RenderService(options.workers, options.max_queue,
+                            plan_cache=PlanCache(options.plan_cache, memory_items=64, memory_bytes=int(options.plan_memory*2**20)),
+                            client=client, verbose=options.verbose)
+    if options.socket:
+        server = UnixRenderServer(options.socket, service, options.verbose)
+        where = options.socket
+    else:
+        server = RenderServer((options.host, options.port), service, options.verbose)
+        where = "http://{0}:{1}".format(*server.server_address[:2])
+    print ("Render service at {0}, {1} workers".format(where, options.workers), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        client.close()
+        if options.socket and os.path.exists(options.socket):
+            os.unlink(options.socket)
+
+if __name__=="__main__": main()
@@ -8,7 +8,7 @@ setup(name='log-zoom',
       author_email='shintyakov@gmail.com',
       url='https://github.com/dmishin/log-zoom',
       packages=[],
-      scripts=['auto_glue.py','gmap_get.py','log_transform.py','mercator2ortho.py'],
+      scripts=['auto_glue.py','batch_glue.py','gmap_get.py','log_transform.py','mercator2ortho.py','map_stub_server.py','zoom_animation.py','render_server.py'],
       license='MIT',
-      requires=["pillow"]
+      requires=["pillow", "numpy"]
 )
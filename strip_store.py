@@ -0,0 +1,110 @@
+"""Persistent store of the transformed fragments (strips) of the glued maps, for the incremental re-rendering"""
+from plan_cache import _canonical
+from PIL import Image
+import instrument
+import threading
+import tempfile
+import hashlib
+import json
+import glob
+import os
+
+#Increase when rendering of the strips changes
+strip_format_version = 1
+
+class StripStore:
+    """Transformed fragments of the glued maps in a folder.
+
+    Every strip is a band of rows of the transformed fragment (see auto_glue.fragment_bands), stored as PNG file,
+    named by the fingerprint of all inputs of the transform and the band: FINGERPRINT_Y0_Y1.png.
+    Strip can be used for any band inside of the stored one, so it stays valid when neighbour zoom levels change the band.
+    """
+    def __init__(self, folder, compress_level=1):
+        self.folder = folder
+        self.compress_level = compress_level
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def key(**inputs):
+        """Fingerprint of the strip inputs: map server, fragment request, feather mask and render settings"""
+        description = [strip_format_version, sorted(inputs.items())]
+        return hashlib.sha1(json.dumps(_canonical(description)).encode("ascii")).hexdigest()
+
+    def _bands(self, key):
+        """Stored bands of the fingerprint: list of (y0, y1, path)"""
+        bands = []
+        for path in glob.glob(os.path.join(self.folder, key + "_*_*.png")):
+            try:
+                y0, y1 = map(int, os.path.basename(path)[len(key)+1:-4].split("_"))
+            except ValueError:
+                continue
+            bands.append((y0, y1, path))
+        return bands
+
+    def _find(self, key, band):
+        y0, y1 = band
+        containing = [stored for stored in self._bands(key) if stored[0] <= y0 and stored[1] >= y1]
+        return min(containing, key=lambda stored: stored[1]-stored[0]) if containing else None
+
+    def _count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        instrument.count("strip_store_hits" if hit else "strip_store_misses")
+
+    def contains(self, key, band):
+        """True if the strip with the band (y0, y1) can be loaded. Missing strips are counted as misses,
+        strips found are counted by get, as hits or as misses, if they can not be read"""
+        found = self._find(key, band) is not None
+        if not found:
+            self._count(False)
+        return found
+
+    def get(self, key, band):
+        """Stored strip, cropped to the band, or None. Strips, that can not be read, are removed"""
+        found = self._find(key, band)
+        image = None
+        if found is not None:
+            stored_y0, _, path = found
+            try:
+                with instrument.stage("decode"):
+                    image = Image.open(path).convert("RGBA")
+                    image = image.crop((0, band[0]-stored_y0, image.size[0], band[1]-stored_y0))
+            except (IOError, ValueError):
+                #Damaged strip is dropped, and rendered again by the caller
+                image = None
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+        self._count(image is not None)
+        return image
+
+    def put(self, key, band, image):
+        """Store the strip with the band (y0, y1). Stored strips of the same fingerprint inside of the band are removed"""
+        y0, y1 = band
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, prefix=".tmp-", suffix=".png")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                with instrument.stage("encode"):
+                    image.save(tmp_file, "PNG", compress_level=self.compress_level)
+            os.replace(tmp_path, os.path.join(self.folder, "{0}_{1}_{2}.png".format(key, y0, y1)))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        for stored_y0, stored_y1, path in self._bands(key):
+            if stored_y0 >= y0 and stored_y1 <= y1 and (stored_y0, stored_y1) != (y0, y1):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    def summary(self):
+        requests = self.hits + self.misses
+        return "Strip store: {0} hits, {1} misses ({2:.0%} hit rate)".format(
+            self.hits, self.misses, self.hits / requests if requests else 0)
@@ -0,0 +1,133 @@
+"""Writing DeepZoom tile pyramids by horizontal strips, without keeping the whole image in memory"""
+from PIL import Image
+from math import *
+import numpy as np
+import instrument
+import os
+
+def downsample_rows(rows):
+    """Average 2x2 blocks of the RGBA rows (HxWx4 array with even H), weighting colors by alpha.
+    Image wraps around horizontally: if width is odd, the last column is averaged with the first one.
+    """
+    if rows.shape[1] % 2:
+        rows = np.concatenate([rows, rows[:,:1]], axis=1)
+    pixels = rows.astype(np.uint32)
+    alpha = pixels[...,3:]
+    color = pixels[...,:3] * alpha
+    def pool(a):
+        return a[0::2,0::2] + a[1::2,0::2] + a[0::2,1::2] + a[1::2,1::2]
+    alpha = pool(alpha)
+    color = pool(color)
+    out = np.empty(alpha.shape[:2] + (4,), dtype=np.uint8)
+    out[...,3] = (alpha[...,0] + 2) // 4
+    out[...,:3] = (color + alpha//2) // np.maximum(alpha, 1)
+    return out
+
+class _Level:
+    def __init__(self, index, size):
+        self.index = index
+        self.size = size
+        #Rows, not written to the tiles yet
+        self.pending = np.zeros((0, size[0], 4), dtype=np.uint8)
+        self.tile_rows_written = 0
+        #Last row of the odd number of rows, waiting for the pair to be downsampled
+        self.carry = None
+
+class TilePyramidWriter:
+    """Writes DeepZoom tile pyramid: descriptor PATH.dzi and tiles PATH_files/LEVEL/COLUMN_ROW.FORMAT,
+    receiving RGBA image rows by strips, from top to bottom.
+    Usage:
+       with TilePyramidWriter("map.dzi", (width, height)) as writer:
+           for y0, strip in strips:
+               writer.write_strip(y0, strip)
+    Lower levels are built incrementally, by averaging pairs of rows as soon as they arrive (see downsample_rows),
+    so only up to tile_size rows of every level are in memory.
+    Descriptor is written by close(), when all tiles are complete.
+    """
+    def __init__(self, path, size, tile_size=256, tile_format="png"):
+        if tile_format not in ("png", "jpg"):
+            raise ValueError("Unsupported tile format: {0}".format(tile_format))
+        self.path = path
+        self.folder = os.path.splitext(path)[0] + "_files"
+        self.size = size
+        self.tile_size = tile_size
+        self.tile_format = tile_format
+        self.rows_written = 0
+        self.tiles_written = 0
+        width, height = size
+        max_level = int(ceil(log2(max(width, height, 1))))
+        #Levels from the full resolution down to the single pixel
+        self.levels = []
+        for index in range(max_level, -1, -1):
+            self.levels.append(_Level(index, (width, height)))
+            width, height = -(-width // 2), -(-height // 2)
+        self.closed = False
+
+    def write_strip(self, y0, strip):
+        """Write next rows of the image. Strip is a PIL image or HxWx4 array; y0 must be the next row to write"""
+        if y0 != self.rows_written:
+            raise ValueError("Strips must be written sequentially: expected row {0}, got {1}".format(self.rows_written, y0))
+        if hasattr(strip, "mode"):
+            if strip.mode != "RGBA":
+                strip = strip.convert("RGBA")
+            strip = np.asarray(strip)
+        if strip.shape[1] != self.size[0]:
+            raise ValueError("Strip width does not match image width")
+        if self.rows_written + strip.shape[0] > self.size[1]:
+            raise ValueError("Too many rows written")
+        self._add_rows(0, strip)
+        self.rows_written += strip.shape[0]
+
+    def _add_rows(self, i, rows):
+        level = self.levels[i]
+        level.pending = np.concatenate([level.pending, rows])
+        while len(level.pending) >= self.tile_size:
+            self._write_tile_row(level, level.pending[:self.tile_size])
+            level.pending = level.pending[self.tile_size:]
+        if i+1 < len(self.levels):
+            if level.carry is not None:
+                rows = np.concatenate([level.carry, rows])
+            paired = len(rows) // 2 * 2
+            level.carry = rows[paired:] if paired < len(rows) else None
+            if paired:
+                self._add_rows(i+1, downsample_rows(rows[:paired]))
+
+    def _write_tile_row(self, level, rows):
+        folder = os.path.join(self.folder, str(level.index))
+        if level.tile_rows_written == 0:
+            os.makedirs(folder, exist_ok=True)
+        row = level.tile_rows_written
+        for column, x0 in enumerate(range(0, level.size[0], self.tile_size)):
+            tile = Image.fromarray(np.ascontiguousarray(rows[:, x0:x0+self.tile_size]), "RGBA")
+            if self.tile_format == "jpg":
+                tile = tile.convert("RGB")
+            tile.save(os.path.join(folder, "{0}_{1}.{2}".format(column, row, self.tile_format)))
+        level.tile_rows_written += 1
+        self.tiles_written += column + 1
+        instrument.count("tiles", column + 1)
+
+    def close(self):
+        if self.closed: return
+        if self.rows_written != self.size[1]:
+            raise ValueError("Image is incomplete: {0} rows of {1} written".format(self.rows_written, self.size[1]))
+        for i, level in enumerate(self.levels):
+            if level.carry is not None:
+                #Odd height: the last row is averaged with itself
+                carry, level.carry = level.carry, None
+                self._add_rows(i+1, downsample_rows(np.concatenate([carry, carry])))
+            if len(level.pending):
+                self._write_tile_row(level, level.pending)
+                level.pending = level.pending[:0]
+        with open(self.path, "w") as descriptor:
+            descriptor.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                             '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{0}" Overlap="0" TileSize="{1}">\n'
+                             '  <Size Width="{2}" Height="{3}"/>\n'
+                             '</Image>\n'.format(self.tile_format, self.tile_size, self.size[0], self.size[1]))
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
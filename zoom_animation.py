@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""Render frames of the "infinite zoom" animation from the logarithmic map.
+Every frame is the inverse log-polar transform of the map (see invlog_transform.py) with different top line and angle.
+Both only translate the source coordinates, so the mesh (or the coordinate map) is computed once and shifted for every frame.
+"""
+from PIL import Image
+from math import *
+from collections import deque
+from invlog_transform import inv_logpolar_transform
+from image_distort import make_mesh, sample_pixels, sample_mipmap, premultiply_alpha, _mesh_to_list, _transform_mipmap, _mip_lod, _source_pyramid, _resample_filters
+import multiprocessing
+import itertools
+import numpy as np
+import instrument
+import sys
+import os
+
+class ZoomAnimation:
+    """Renders frames of the inverse log-polar transform of the source image with the given size.
+    Frame is defined by the top line of the source (y0) and the rotation angle, in radians.
+
+    Engines:
+      mesh - mesh of the frame with y0=0 and zero angle is built once, and its quads are shifted for every frame.
+        Source is tiled twice horizontally, so that shifted quads never cross the edge of the source.
+      remap - exact source coordinates of every pixel are computed once, and shifted (with wrapping) for every frame.
+    """
+    def __init__(self, source, out_size, resample=Image.BICUBIC, mipmap=False, engine="mesh", mesh_step=8):
+        if source.mode != "RGBA":
+            source = source.convert("RGBA")
+        self.out_size = out_size
+        self.resample = resample
+        self.mipmap = mipmap
+        self.engine = engine
+        out_width, out_height = out_size
+        #Width of the source, corresponding to the full turn
+        self.period = source.size[0] - 1
+        tfm = inv_logpolar_transform(source.size, 0, out_width, out_height)
+        if engine == "mesh":
+            with instrument.stage("mesh"):
+                mesh = make_mesh(tfm.vectorized, out_width, out_height, mesh_step)
+            self.boxes = np.array([box for box, _ in mesh], dtype=np.int64).reshape(-1, 4)
+            self.quads = np.array([quad for _, quad in mesh], dtype=np.float64).reshape(-1, 8)
+            self.source = Image.new(source.mode, (self.period + source.size[0], source.size[1]))
+            self.source.paste(source, (0, 0))
+            self.source.paste(source, (self.period, 0))
+        elif engine == "remap":
+            #Coordinates are sampled in the pixel centers
+            x, y = np.meshgrid(np.arange(out_width) + 0.5, np.arange(out_height) + 0.5)
+            with instrument.stage("mesh"):
+                self.u, self.v = tfm.vectorized(x.ravel(), y.ravel())
+            instrument.count("transform_points", x.size)
+            self.source = source
+            #Source is premultiplied once, not for every frame
+            self.premultiplied = mipmap or resample != Image.NEAREST
+            self.pixels = np.asarray(source)
+            if self.premultiplied:
+                self.pixels = premultiply_alpha(self.pixels)
+            if mipmap:
+                #Translation does not change the scale, so levels of detail are the same for all frames
+                self.levels = [premultiply_alpha(np.asarray(level)) for level in _source_pyramid(source)]
+                self.lod = _mip_lod(self.u.reshape(out_height, out_width), self.v.reshape(out_height, out_width),
+                                    len(self.levels)-1).ravel()
+        else:
+            raise ValueError("Unknown transform engine: {0}".format(engine))
+
+    def frame(self, y0, angle=0.0):
+        """Render one frame, returns RGBA image"""
+        out_width, out_height = self.out_size
+        shift = (angle/(2*pi)*self.period) % self.period
+        instrument.count("frames")
+        if self.engine == "mesh":
+            with instrument.stage("transform"):
+                mesh = _mesh_to_list(self.boxes, self.quads + (shift, y0)*4)
+                if self.mipmap:
+                    return _transform_mipmap(self.source, self.out_size, mesh, self.resample, False)
+                return self.source.transform(self.out_size, Image.MESH, mesh, self.resample)
+
+        with instrument.stage("remap"):
+            u = np.mod(self.u + shift, self.period)
+            v = self.v + y0
+            if self.mipmap:
+                pixels = sample_mipmap(self.levels, u, v, self.lod, self.resample, premultiplied=True)
+            else:
+                pixels = sample_pixels(self.pixels, u, v, self.resample, self.premultiplied)
+        return Image.fromarray(pixels.reshape(out_height, out_width, 4), "RGBA")
+
+def linear_schedule(frames, top_range, angle_range=(0.0, 0.0)):
+    """List of (y0, angle) pairs, changing linearly from the start to the end values"""
+    def interpolate(value_range, i):
+        start, end = value_range
+        return start + (end-start) * i / max(1, frames-1)
+    return [(interpolate(top_range, i), interpolate(angle_range, i)) for i in range(frames)]
+
+def read_schedule(path):
+    """Read schedule file: one frame per line, "Y0 [ANGLE]", angle in degrees. Empty lines and #comments are ignored"""
+    schedule = []
+    with open(path) as schedule_file:
+        for line_number, line in enumerate(schedule_file, 1):
+            line = line.split("#", 1)[0].strip()
+            if not line: continue
+            try:
+                values = [float(value) for value in line.split()]
+                if len(values) not in (1, 2): raise ValueError("expected Y0 [ANGLE]")
+            except ValueError as err:
+                raise ValueError("Line {0}: {1}".format(line_number, err))
+            schedule.append((values[0], radians(values[1]) if len(values) > 1 else 0.0))
+    return schedule
+
+#Animation of the worker processes. It is set before the pool is created, and inherited by the forked processes.
+_worker_animation = None
+
+def _render_frame(animation, task):
+    """Render frame of the task, and either save it or return its bytes"""
+    index, y0, angle, output = task
+    frame = animation.frame(y0, angle)
+    if output is None:
+        return frame.tobytes()
+    with instrument.stage("encode"):
+        frame.save(output)
+    return index
+
+def _frame_worker(task):
+    result = _render_frame(_worker_animation, task)
+    report = instrument.snapshot()
+    instrument.reset()
+    return result, report
+
+def render_frames(animation, schedule, output_pattern=None, jobs=1):
+    """Render frames of the schedule (list of (y0, angle) pairs).
+    If output_pattern is given, frames are saved to the files output_pattern.format(index), and indices are generated;
+    otherwise raw RGBA bytes of the frames are generated.
+    Frames are generated in order; with jobs>1, they are rendered by a pool of processes, up to 2*jobs frames at a time.
+    """
+    global _worker_animation
+    tasks = [(i, y0, angle, output_pattern and output_pattern.format(i)) for i, (y0, angle) in enumerate(schedule)]
+    context = None
+    if jobs > 1:
+        try:
+            context = multiprocessing.get_context("fork")
+        except ValueError:
+            pass
+    if context is None:
+        for task in tasks:
+            yield _render_frame(animation, task)
+        return
+
+    _worker_animation = animation
+    try:
+        with context.Pool(jobs) as pool:
+            _worker_animation = None
+            #Keep limited number of frames in flight, so that slow consumer does not make them accumulate in memory.
+            pending = deque()
+            remaining = iter(tasks)
+            for task in itertools.islice(remaining, 2*jobs):
+                pending.append(pool.apply_async(_frame_worker, (task,)))
+            while pending:
+                result, report = pending.popleft().get()
+                instrument.merge(report)
+                for task in itertools.islice(remaining, 1):
+                    pending.append(pool.apply_async(_frame_worker, (task,)))
+                yield result
+    finally:
+        _worker_animation = None
+
+def parse_range(text):
+    """Parse START:END pair of floats"""
+    start, end = text.split(":", 1)
+    return float(start), float(end)
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage = "%prog [options] INPUT_IMAGE OUTPUT_PATTERN\n"
+                          "Render frames of the zoom animation from the logarithmic map (inverse log-polar transform).\n"
+                          "OUTPUT_PATTERN is the file name with the frame number field, like frames/frame{0:05d}.png,\n"
+                          "or - to write raw RGBA frames to the standard output, e.g. for:\n"
+                          "  ffmpeg -f rawvideo -pix_fmt rgba -s WIDTHxHEIGHT -i - zoom.mp4")
+    parser.add_option("-w", "--width", dest="width", type=int, default=1024,
+                      help="Width of the frames", metavar="PIXELS")
+    parser.add_option("-H", "--height", dest="height", type=int, default=1024,
+                      help="Height of the frames", metavar="PIXELS")
+    parser.add_option("-n", "--frames", dest="frames", type=int, default=100,
+                      help="Number of frames. Default is 100", metavar="N")
+    parser.add_option("-t", "--top", dest="top", default=None,
+                      help="Range of the top line of the source, changing linearly over the frames. Default is from 0 to the bottom of the source", metavar="Y0:Y1")
+    parser.add_option("-A", "--angle", dest="angle", default="0:0",
+                      help="Range of the rotation angle in graduses, changing linearly over the frames. Default is 0:0", metavar="A0:A1")
+    parser.add_option("-s", "--schedule", dest="schedule", metavar="FILE",
+                      help="Read frames from the file: one frame per line, \"Y0 [ANGLE]\". Overrides --frames, --top and --angle")
+    parser.add_option("", "--mesh-step", dest="mesh_step", type=int, default=8, metavar="PIXELS",
+                      help="Step of the output mesh. Default is 8")
+    parser.add_option("", "--engine", dest="engine", default="mesh", choices=["mesh", "remap"],
+                      help="Transform engine: mesh (interpolated distortion, default) or remap (exact coordinates of every pixel)")
+    parser.add_option("", "--filter", dest="filter", default="bicubic", choices=sorted(_resample_filters),
+                      help="Resampling filter: nearest, bilinear or bicubic (default)")
+    parser.add_option("", "--mipmap", dest="mipmap", action="store_true", default=False,
+                      help="Sample minified regions from the prefiltered pyramid of the source image, to avoid aliasing")
+    parser.add_option("-j", "--jobs", dest="jobs", type=int, default=1, metavar="N",
+                      help="Number of processes for rendering. Default is 1")
+    parser.add_option("", "--stats", dest="stats", metavar="FILE.json",
+                      help="Write time of the processing stages, counters and peak memory use to the JSON file")
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.error("Input image and output pattern expected")
+    input, output = args
+    if output != "-":
+        try:
+            if output.format(0) == output.format(1):
+                parser.error("Output pattern must contain frame number field, like {0:05d}")
+        except (IndexError, KeyError, ValueError) as err:
+            parser.error("Bad output pattern: {0}".format(err))
+
+    img = Image.open(input)
+    if options.schedule:
+        try:
+            schedule = read_schedule(options.schedule)
+        except (IOError, ValueError) as err:
+            parser.error("Failed to read schedule: {0}".format(err))
+    else:
+        try:
+            top_range = parse_range(options.top) if options.top else (0, img.size[1])
+            angle_range = tuple(map(radians, parse_range(options.angle)))
+        except ValueError as err:
+            parser.error("Failed to parse range: {0}".format(err))
+        schedule = linear_schedule(options.frames, top_range, angle_range)
+
+    #Progress goes to stderr, because stdout may be the frame stream
+    log = sys.stderr if output == "-" else sys.stdout
+    animation = ZoomAnimation(img, (options.width, options.height),
+                              resample=_resample_filters[options.filter], mipmap=options.mipmap,
+                              engine=options.engine, mesh_step=options.mesh_step)
+    if output == "-":
+        stream = sys.stdout.buffer
+        for data in render_frames(animation, schedule, jobs=options.jobs):
+            stream.write(data)
+        stream.flush()
+    else:
+        output_dir = os.path.dirname(output)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        for index in render_frames(animation, schedule, output, jobs=options.jobs):
+            print ("Frame {0}/{1}".format(index+1, len(schedule)), file=log)
+    print ("Rendered {0} frames".format(len(schedule)), file=log)
+    if options.stats:
+        instrument.save(options.stats)
+
+if __name__=="__main__": main()